@@ -1,23 +1,195 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import csv
 from datetime import datetime
-from functools import reduce
+from functools import lru_cache, reduce
+import hashlib
+import importlib
 import io
 import json
 import logging
+import math
+import operator
 import os
+import pickle
 import re
+import sys
+import tempfile
+import threading
+import time
 import traceback
-from typing import Any
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
 
 import azure.functions as func
-from azure.storage.blob import BlobServiceClient
 
-import country_converter as coco
-import numpy as np
-import pandas as pd
-import requests
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobClient, BlobServiceClient
+    import numpy as np
+    import pandas as pd
+    import requests
+
+
+IMPORT_TIMINGS = {}
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used. The import time is recorded
+    in IMPORT_TIMINGS and the module level name is then rebound to the real module
+    """
+
+    def __init__(self, module_name: str, alias: str):
+        self._module_name = module_name
+        self._alias = alias
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._module_name)
+            IMPORT_TIMINGS[self._module_name] = time.perf_counter() - start
+            globals()[self._alias] = self._module
+
+        return getattr(self._module, attribute)
+
+
+# heavy dependencies are only needed for processed files, so they are loaded on first use to keep cold starts short
+azure_blob = LazyModule('azure.storage.blob', 'azure_blob')
+np = LazyModule('numpy', 'np')
+pd = LazyModule('pandas', 'pd')
+requests = LazyModule('requests', 'requests')
+
+
+COUNTRY_CODES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'country_codes.csv')
+COUNTRY_CODE_COLUMNS = {'name_short': 'name_short', 'iso2': 'ISO2', 'iso3': 'ISO3'}
+# codes country_converter accepts besides the ISO2 code, by the ISO3 code of their country
+COUNTRY_CODE_ALIASES = {'UK': 'GBR', 'EL': 'GRC'}
+
+FACEBOOK_COLUMNS = ['giga_id_school', 'percent_2G', 'percent_3G', 'percent_4G']
+
+ITU_COLUMNS = ['giga_id_school', '2G', '3G', '4G', 'fiber_node_distance', 'microwave_node_distance',
+               'nearest_school_distance', 'Schools_within_1km', 'Schools_within_2km', 'Schools_within_3km',
+               'Schools_within_10km', 'schools_within_1km', 'schools_within_2km', 'schools_within_3km',
+               'schools_within_10km', 'nearest_LTE_id', 'nearest_LTE_distance', 'nearest_UMTS_id',
+               'nearest_UMTS_distance', 'nearest_GSM_id', 'nearest_GSM_distance', 'pop_within_1km',
+               'pop_within_2km', 'pop_within_3km', 'pop_within_10km']
+
+# ITU columns carried into the processed coverage data, after lower casing the Schools_within_* columns
+ITU_COVERAGE_COLUMNS = ['fiber_node_distance', 'microwave_node_distance', 'nearest_school_distance',
+                        'schools_within_1km', 'schools_within_2km', 'schools_within_3km', 'schools_within_10km',
+                        'nearest_LTE_id', 'nearest_LTE_distance', 'nearest_UMTS_id', 'nearest_UMTS_distance',
+                        'nearest_GSM_id', 'nearest_GSM_distance', 'pop_within_1km', 'pop_within_2km',
+                        'pop_within_3km', 'pop_within_10km']
+
+# compact dtypes the partner and master columns are converted to as they are parsed. A column keeps its parsed dtype
+# when any of its values does not fit, and integer columns with missing values are held as float32 instead
+FACEBOOK_SCHEMA = {'percent_2G': 'float32', 'percent_3G': 'float32', 'percent_4G': 'float32'}
+
+ITU_SCHEMA = {'2G': 'int8', '3G': 'int8', '4G': 'int8', 'Schools_within_1km': 'int32', 'Schools_within_2km': 'int32',
+              'Schools_within_3km': 'int32', 'Schools_within_10km': 'int32', 'schools_within_1km': 'int32',
+              'schools_within_2km': 'int32', 'schools_within_3km': 'int32', 'schools_within_10km': 'int32',
+              'pop_within_1km': 'int32', 'pop_within_2km': 'int32', 'pop_within_3km': 'int32',
+              'pop_within_10km': 'int32'}
+
+MASTER_SCHEMA = {'education_level': 'category', 'education_level_regional': 'category', 'school_type': 'category',
+                 'connectivity': 'category', 'type_connectivity': 'category', 'coverage_availability': 'category',
+                 'coverage_type': 'category', 'admin1': 'category', 'admin2': 'category', 'admin3': 'category',
+                 'admin4': 'category', 'school_region': 'category', 'computer_availability': 'category',
+                 'computer_lab': 'category', 'electricity': 'category', 'water': 'category', 'num_computers': 'int32',
+                 'num_teachers': 'int32', 'num_students': 'int32', 'num_classroom': 'int32'}
+
+# coverage sources, each found in its coverage-data-<partner> container. file_prefix is formatted with the country's
+# ISO codes, in upper case as ISO2 and ISO3 or lower case as iso2 and iso3. Each coverage rule sets the flag of a
+# technology by comparing a column with a value, where missing values never count as coverage. renamed_columns are
+# applied before the coverage rules, and coverage_columns are carried from the partner into the processed coverage data
+PARTNERS = {
+    'facebook': {
+        'file_prefix': 'processed/{ISO2}',
+        'columns': FACEBOOK_COLUMNS,
+        'schema': FACEBOOK_SCHEMA,
+        'coverage_rules': {'2G': ('percent_2G', operator.gt, 0), '3G': ('percent_3G', operator.gt, 0),
+                           '4G': ('percent_4G', operator.gt, 0)},
+        'renamed_columns': {},
+        'coverage_columns': [],
+    },
+    'itu': {
+        'file_prefix': 'processed/{iso3}',
+        'columns': ITU_COLUMNS,
+        'schema': ITU_SCHEMA,
+        'coverage_rules': {'2G': ('2G', operator.ge, 1), '3G': ('3G', operator.eq, 1), '4G': ('4G', operator.eq, 1)},
+        'renamed_columns': {'Schools_within_1km': 'schools_within_1km', 'Schools_within_2km': 'schools_within_2km',
+                            'Schools_within_3km': 'schools_within_3km', 'Schools_within_10km': 'schools_within_10km'},
+        'coverage_columns': ITU_COVERAGE_COLUMNS,
+    },
+}
+
+PARTNERS_LIST = list(PARTNERS)
+
+COVERAGE_TECHNOLOGIES = ('2G', '3G', '4G')
+COVERAGE_TYPES = ['2G', '3G', '4G', 'no coverage']
+YES_NO = ['NO', 'YES']
+# part of the coverage rules fingerprint kept in the coverage state, raise it when process_coverage_data changes how
+# schools are processed, so that the next incremental run processes every school again
+COVERAGE_STATE_VERSION = 1
+COVERAGE_RULES_FINGERPRINT_COLUMN = '_rules_fingerprint'
+
+MASTER_COLUMNS = ['giga_id_school', 'school_id', 'name', 'lat', 'lon', 'education_level',
+                  'education_level_regional', 'school_type',
+                  'connectivity', 'connectivity_speed', 'type_connectivity', 'coverage_availability', 'coverage_type',
+                  'latency_connectivity', 'admin1', 'admin2', 'admin3', 'admin4', 'school_region', 'num_computers',
+                  'num_teachers', 'num_students', 'num_classroom', 'computer_availability', 'computer_lab',
+                  'electricity', 'water',
+                  'address', 'fiber_node_distance', 'microwave_node_distance',
+                  'nearest_school_distance', 'schools_within_1km', 'schools_within_2km', 'schools_within_3km',
+                  'schools_within_10km', 'nearest_LTE_id', 'nearest_LTE_distance', 'nearest_UMTS_id',
+                  'nearest_UMTS_distance', 'nearest_GSM_id', 'nearest_GSM_distance', 'pop_within_1km',
+                  'pop_within_2km', 'pop_within_3km',
+                  'pop_within_10km']
+
+# the master may also be stored as Parquet, see select_source_blob
+MASTER_SOURCE = {'file_prefix': 'gold/school_data/{ISO3}', 'columns': MASTER_COLUMNS, 'schema': MASTER_SCHEMA,
+                 'reads_parquet': True}
+
+DEFAULT_BLOB_READ_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_CSV_READ_CHUNK_ROWS = 100_000
+DEFAULT_BLOB_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_BLOB_UPLOAD_MAX_CONCURRENCY = 2
+DEFAULT_HTTP_POOL_SIZE = 16
+DEFAULT_DEBOUNCE_SECONDS = 0
+DEFAULT_COALESCE_MAX_COUNTRIES = 5
+DEFAULT_COORDINATION_FOLDER = 'coordination'
+DEFAULT_BLOB_INDEX_TTL_SECONDS = 60
+CONTENT_DIGEST_METADATA_KEY = 'content_digest'
+COPY_POLL_SECONDS = 1
+COORDINATION_LEASE_SECONDS = 60
+DEFAULT_OUTPUT_FORMAT = 'csv'
+DEFAULT_PARQUET_COMPRESSION = 'zstd'
+OUTPUT_FORMATS = ('csv', 'parquet')
+PROFILERS = ('cprofile', 'tracemalloc')
+PROFILE_SUMMARY_LINES = 25
+DEFAULT_SLACK_TIMEOUT_SECONDS = 10
+DEFAULT_SLACK_MAX_ATTEMPTS = 4
+DEFAULT_SLACK_RETRY_BACKOFF_SECONDS = 1
+DEFAULT_SLACK_BATCH_SECONDS = 5
+DEFAULT_SLACK_FLUSH_TIMEOUT_SECONDS = 30
+SLACK_BATCH_SEPARATOR = '\n\n'
+DEFAULT_OUT_OF_CORE_MEMORY_LIMIT = 0
+# memory needed to process a file per byte of the file, estimated from the workflow's peak memory on synthetic countries
+OUT_OF_CORE_MEMORY_PER_FILE_BYTE = {'csv': 4, 'parquet': 20}
+SPILL_ROW_COLUMN = '_row'
+SPILL_ORDER_COLUMN = '_order'
 
 
 def main(event: func.EventGridEvent):
+    try:
+        handle_event(event)
+    finally:
+        # deliver the queued Slack messages before the invocation ends, including the errors of a failed one
+        flush_slack_messages()
+
+
+def handle_event(event: func.EventGridEvent):
 
     event_data = event.get_json()
     logging.info(event_data)
@@ -26,12 +198,13 @@ def main(event: func.EventGridEvent):
 
     if not blob_file_path or not str(blob_file_path).endswith('.csv'):
         logging.info(f'Uploaded file {blob_file_path} is not a valid file')
+        log_import_timings()
         return
 
     container_name, folder_name, file_name = blob_file_path.split('/')
     partner_name = container_name.replace('coverage-data-', '')
     country_code = re.split(r'[^a-zA-Z]', file_name)[0]
-    country_name = coco.convert(country_code, to='name_short')
+    country_name = convert_country(country_code, to='name_short')
 
     if folder_name == "unprocessed":
         slack_text = f"File {file_name} for {country_name} has been sent to {partner_name.title()}"
@@ -41,283 +214,2234 @@ def main(event: func.EventGridEvent):
     elif folder_name == "processed":
         slack_text = f"Coverage file {file_name} for {country_name} has been received from {partner_name.title()}"
 
+        record_blob(container=container_name, blob_name=f'{folder_name}/{file_name}', etag=event_data.get('eTag'))
+
         blob_service_client = create_blob_client()
+        coordination_store = create_coordination_store(blob_service_client)
+        with profile_invocation(f'{country_code.upper()}_coverage'):
+            processing_results = process_coalesced(
+                coordination_store=coordination_store, country_name=country_name,
+                process=lambda name: process_country_coverage(blob_service_client=blob_service_client, country_name=name,
+                                                              coordination_store=coordination_store))
+
+        slack_text += "\n"
+        slack_text += processing_results.pop(
+            country_name, f"Coverage processing for {country_name} is already running and will include this file")
+
+        for other_country_name, result_text in processing_results.items():
+            slack_text += "\n"
+            slack_text += f"{other_country_name}: {result_text}"
+    
+    logging.info("Queueing Slack message")
+    send_slack_message(message=slack_text)
+
+    logging.info(f'Python Blob trigger function processed {file_name}')
+    log_import_timings()
+
+
+def process_country_coverage(blob_service_client: 'BlobServiceClient', country_name: str,
+                             delete_partner_files: bool = True, incremental: bool = None,
+                             coordination_store: 'LocalCoordinationStore | BlobCoordinationStore' = None) -> str:
+    """
+    Runs the coverage workflow for a country; fetches the partner and master data, processes and merges the coverage
+    data, stores the files and deletes the processed partner files
+
+    :param blob_service_client: The blob service client
+    :param country_name: The short name of the country
+    :param delete_partner_files: Whether the processed partner files are deleted once the files are stored
+    :param incremental: Whether only the schools whose partner rows changed are processed, the INCREMENTAL_PROCESSING
+        setting by default. A full run still refreshes the coverage state when the setting is on, so later incremental
+        runs can use it
+    :param coordination_store: The store of the country's lease held for the run, if any. The files are only stored
+        while the lease is still held, see check_lease
+    :returns: str, the outcome to report on Slack
+    """
+    try:
+        partitions = get_out_of_core_partitions(blob_service_client=blob_service_client, country_name=country_name)
+    except Exception as e:
+        error_text = f"Error while getting partner and master data for {country_name}:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    if partitions > 1:
+        return process_country_coverage_out_of_core(blob_service_client=blob_service_client, country_name=country_name,
+                                                    partitions=partitions, delete_partner_files=delete_partner_files,
+                                                    coordination_store=coordination_store)
+
+    try:
+        with measure_stage('fetch', country=country_name):
+            partners_data_dict, master_df = get_partner_data(blob_service_client, country_name,
+                                                             partners_list=PARTNERS_LIST)
+    except Exception as e:
+        error_text = f"Error while getting partner and master data for {country_name}:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    if type(partners_data_dict) == type(None):
+        return f"Coverage files not processed. Not enough partner data. At least 2 sources required\n"
+
+    try:
+        partner_file_paths = {partner: partners_data_dict[partner]['file_path'] for partner in PARTNERS_LIST}
+        *partner_dfs, master_df = encode_school_ids(
+            *[partners_data_dict[partner]['data'] for partner in PARTNERS_LIST], master_df)
+        partner_dfs = dict(zip(PARTNERS_LIST, partner_dfs))
+        coverage_state_df = None
+        keeps_coverage_state = incremental or incremental_processing_enabled()
+        if incremental is None:
+            incremental = incremental_processing_enabled()
+        with measure_stage('process', country=country_name, incremental=incremental) as metrics:
+            if keeps_coverage_state:
+                coverage_df, coverage_state_df = process_coverage_data_incrementally(
+                    blob_service_client=blob_service_client, country_name=country_name, partner_dfs=partner_dfs,
+                    full=not incremental)
+            else:
+                coverage_df = process_coverage_data(partner_dfs=partner_dfs)
+            metrics['rows'] = len(coverage_df)
+    except Exception as e:
+        error_text = f"Error while processing coverage data:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    try:
+        with measure_stage('merge', country=country_name) as metrics:
+            master_with_coverage = merge_coverage_and_master(master_df=master_df, coverage_df=coverage_df)
+            metrics['rows'] = len(master_with_coverage)
+    except Exception as e:
+        error_text = f"Error while processing coverage data:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    try:
+        with measure_stage('store', country=country_name):
+            check_lease(coordination_store=coordination_store, country_name=country_name)
+            store_files(country_name=country_name, blob_service_client=blob_service_client,
+                        partner_file_paths=partner_file_paths, coverage_df=coverage_df, master_df=master_with_coverage)
+            if type(coverage_state_df) != type(None):
+                store_coverage_state(blob_service_client=blob_service_client, country_name=country_name,
+                                     coverage_state_df=coverage_state_df)
+    except Exception as e:
+        error_text = f"Error while saving files:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    if not delete_partner_files:
+        return f"Coverage data has been processed and saved"
+
+    try:
+        with measure_stage('delete', country=country_name):
+            delete_processed_partner_data(blob_service_client=blob_service_client,
+                                          partners_data_dict=partners_data_dict)
+    except Exception as e:
+        error_text = f"Error while deleting files:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    return f"Coverage data has been processed and saved"
+
+
+def process_coalesced(coordination_store: 'LocalCoordinationStore | BlobCoordinationStore', country_name: str,
+                      process: Callable[[str], str]) -> dict[str, str]:
+    """
+    Collapses bursts of events for a country into as few processing runs as possible. The event marks the country as
+    pending and processes it only if no other invocation holds the country's lease. The holder of the lease keeps
+    processing while the country is marked pending again, so events arriving during a run are served by one more run.
+    Afterwards other pending countries whose lease is free are processed in the same invocation, up to
+    COALESCE_MAX_COUNTRIES countries in total
+
+    :param coordination_store: The store of the pending markers and country leases
+    :param country_name: The short name of the country of the event
+    :param process: The function processing a country, returning the outcome to report
+    :returns: dict[str, str], the outcome of every country processed by this invocation
+    """
+    coordination_store.mark_pending(country_name)
+
+    debounce_seconds = float(os.environ.get('DEBOUNCE_SECONDS', DEFAULT_DEBOUNCE_SECONDS))
+    if debounce_seconds:
+        time.sleep(debounce_seconds)
+
+    processing_results = {}
+    process_pending_country(coordination_store, country_name, process, processing_results)
+
+    max_countries = int(os.environ.get('COALESCE_MAX_COUNTRIES', DEFAULT_COALESCE_MAX_COUNTRIES))
+    for other_country_name in coordination_store.list_pending():
+        if len(processing_results) >= max_countries:
+            break
+        if other_country_name in processing_results:
+            continue
 
         try:
-            partners_list = ['facebook', 'itu']
-            partners_data_dict, master_df = get_partner_data(blob_service_client, country_name, partners_list=partners_list)
-        except Exception as e:
-            error_text = f"Error while getting partner and master data for {country_name}:\n{traceback.format_exc()}"
-            send_slack_message(message=error_text)
-            raise
+            process_pending_country(coordination_store, other_country_name, process, processing_results)
+        except Exception:
+            logging.exception(f'Error while processing pending country {other_country_name}')
+            processing_results[other_country_name] = "Coverage processing failed"
 
-        if type(partners_data_dict) == type(None):
-            slack_text += "\n"
-            slack_text += f"Coverage files not processed. Not enough partner data. At least 2 sources required\n"
-        
-        else:
-        
-            try:
-                facebook_df = partners_data_dict['facebook']['data']
-                itu_df = partners_data_dict['itu']['data']
-                coverage_df = process_coverage_data(facebook_df=facebook_df, itu_df=itu_df)
-            except Exception as e:
-                error_text = f"Error while processing coverage data:\n{traceback.format_exc()}"
-                send_slack_message(message=error_text)
-                raise
+    return processing_results
 
-            try:
-                master_with_coverage = merge_coverage_and_master(master_df=master_df, coverage_df=coverage_df)
-            except Exception as e:
-                error_text = f"Error while processing coverage data:\n{traceback.format_exc()}"
-                send_slack_message(message=error_text)
-                raise
-                
-            try:
-                store_files(country_name=country_name, blob_service_client=blob_service_client, facebook_df=facebook_df,
-                            itu_df=itu_df, coverage_df=coverage_df, master_df=master_with_coverage)
-            except Exception as e:
-                error_text = f"Error while saving files:\n{traceback.format_exc()}"
-                send_slack_message(message=error_text)
-                raise
 
+def process_pending_country(coordination_store: 'LocalCoordinationStore | BlobCoordinationStore', country_name: str,
+                            process: Callable[[str], str], processing_results: dict[str, str]) -> None:
+    # the pending marker is checked again after releasing the lease, as an event may have failed to get the lease
+    # just before it was released
+    while coordination_store.is_pending(country_name) and coordination_store.acquire_lease(country_name):
+        try:
+            while coordination_store.take_pending(country_name):
+                processing_results[country_name] = process(country_name)
+        finally:
+            coordination_store.release_lease(country_name)
 
-            try:
-                delete_processed_partner_data(blob_service_client=blob_service_client, partners_data_dict=partners_data_dict)
-            except Exception as e:
-                error_text = f"Error while deleting files:\n{traceback.format_exc()}"
-                send_slack_message(message=error_text)
-                raise
 
-            slack_text += "\n"
-            slack_text += f"Coverage data has been processed and saved"
-    
-    logging.info("Sending Slack message")
-    send_slack_message(message=slack_text)
-    logging.info("Slack message successfully sent")
+class LeaseLostError(Exception):
+    pass
 
-    logging.info(f'Python Blob trigger function processed {file_name}')
+
+def check_lease(coordination_store: 'LocalCoordinationStore | BlobCoordinationStore', country_name: str) -> None:
+    """
+    Raises LeaseLostError when the country's lease is no longer held, e.g. after its renewal failed, as another run may
+    then be processing the country and storing its files at the same time
+
+    :param coordination_store: The store of the country's lease, None when the run holds no lease
+    :param country_name: The short name of the country
+    """
+    if type(coordination_store) != type(None) and not coordination_store.holds_lease(country_name):
+        raise LeaseLostError(f'The lease of {country_name} was lost, the files are not stored')
 
 
-def get_partner_data(blob_service_client: BlobServiceClient, country_name: str, 
-                     partners_list: list[str]) -> tuple[dict, pd.DataFrame]:
-    
-    partners_data_dict = {}
+def create_coordination_store(blob_service_client: 'BlobServiceClient') -> 'LocalCoordinationStore | BlobCoordinationStore':
+    """
+    Returns the coordination store selected by the COORDINATION_STORE setting. The blob store, the default, coordinates
+    all instances of the function app. The local store only coordinates the invocations of one worker process
+
+    :param blob_service_client: The blob service client
+    :returns: LocalCoordinationStore | BlobCoordinationStore
+    """
+    if os.environ.get('COORDINATION_STORE', 'blob').lower() == 'local':
+        return local_coordination_store
+
+    return BlobCoordinationStore(blob_service_client=blob_service_client,
+                                 container=os.environ['DATA_CONTAINER_NAME'],
+                                 folder=os.environ.get('COORDINATION_FOLDER', DEFAULT_COORDINATION_FOLDER))
+
+
+class LocalCoordinationStore:
+    """
+    Pending markers and country leases kept in memory, shared by the invocations of one worker process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leased = set()
+
+    def mark_pending(self, country_name: str) -> None:
+        with self._lock:
+            if country_name not in self._pending:
+                self._pending.append(country_name)
+
+    def is_pending(self, country_name: str) -> bool:
+        with self._lock:
+            return country_name in self._pending
+
+    def take_pending(self, country_name: str) -> bool:
+        with self._lock:
+            if country_name not in self._pending:
+                return False
+            self._pending.remove(country_name)
+            return True
+
+    def list_pending(self) -> list[str]:
+        with self._lock:
+            return list(self._pending)
+
+    def acquire_lease(self, country_name: str) -> bool:
+        with self._lock:
+            if country_name in self._leased:
+                return False
+            self._leased.add(country_name)
+            return True
+
+    def holds_lease(self, country_name: str) -> bool:
+        with self._lock:
+            return country_name in self._leased
+
+    def release_lease(self, country_name: str) -> None:
+        with self._lock:
+            self._leased.discard(country_name)
+
+
+local_coordination_store = LocalCoordinationStore()
+
+
+class BlobCoordinationStore:
+    """
+    Pending markers and country leases kept as blobs under a folder of a container, shared by all instances of the
+    function app. A country is pending while its blob under pending/ exists, and it is leased while the blob lease of
+    its blob under locks/ is held. Leases are renewed in the background until they are released; a lease whose renewal
+    failed counts as lost, as it may expire and be acquired by another instance
+    """
+
+    def __init__(self, blob_service_client: 'BlobServiceClient', container: str, folder: str):
+        self._container_client = blob_service_client.get_container_client(container=container)
+        self._folder = folder
+        self._leases = {}
+
+    def _blob_client(self, kind: str, country_name: str) -> 'BlobClient':
+        iso3_code = convert_country(country_name, to='iso3')
+        return self._container_client.get_blob_client(f'{self._folder}/{kind}/{iso3_code}')
 
+    def mark_pending(self, country_name: str) -> None:
+        self._blob_client('pending', country_name).upload_blob(b'', overwrite=True)
+
+    def is_pending(self, country_name: str) -> bool:
+        return self._blob_client('pending', country_name).exists()
+
+    def take_pending(self, country_name: str) -> bool:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            self._blob_client('pending', country_name).delete_blob()
+        except ResourceNotFoundError:
+            return False
+        return True
+
+    def list_pending(self) -> list[str]:
+        prefix = f'{self._folder}/pending/'
+        return [convert_country(blob['name'][len(prefix):], to='name_short')
+                for blob in self._container_client.list_blobs(name_starts_with=prefix)]
+
+    def acquire_lease(self, country_name: str) -> bool:
+        from azure.core.exceptions import HttpResponseError, ResourceExistsError
+
+        lock_blob_client = self._blob_client('locks', country_name)
+        try:
+            lock_blob_client.upload_blob(b'', overwrite=False)
+        except ResourceExistsError:
+            pass
+
+        try:
+            lease = lock_blob_client.acquire_lease(lease_duration=COORDINATION_LEASE_SECONDS)
+        except HttpResponseError as e:
+            if e.status_code == 409:
+                return False
+            raise
+
+        stop_renewing = threading.Event()
+        lease_lost = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(country_name, lease, stop_renewing, lease_lost),
+                         daemon=True).start()
+        self._leases[country_name] = (lease, stop_renewing, lease_lost)
+        return True
+
+    @staticmethod
+    def _renew_lease(country_name: str, lease, stop_renewing: threading.Event, lease_lost: threading.Event) -> None:
+        while not stop_renewing.wait(COORDINATION_LEASE_SECONDS / 2):
+            try:
+                lease.renew()
+            except Exception:
+                logging.exception(f'Error while renewing the lease of {country_name}')
+                lease_lost.set()
+                return
+
+    def holds_lease(self, country_name: str) -> bool:
+        if country_name not in self._leases:
+            return False
+        _, _, lease_lost = self._leases[country_name]
+        return not lease_lost.is_set()
+
+    def release_lease(self, country_name: str) -> None:
+        lease, stop_renewing, _ = self._leases.pop(country_name)
+        stop_renewing.set()
+        try:
+            lease.release()
+        except Exception:
+            # the lease expires on its own after COORDINATION_LEASE_SECONDS
+            logging.exception(f'Error while releasing the lease of {country_name}')
+
+
+def list_countries_with_partner_data(blob_service_client: 'BlobServiceClient', partners_list: list[str]) -> list[str]:
+    """
+    Lists the countries that have a processed coverage file from every partner
+
+    :param blob_service_client: The blob service client
+    :param partners_list: The partners whose coverage files are required
+    :returns: list[str], the short names of the countries
+    """
+    partner_countries = []
     for partner in partners_list:
-        partner_df, partner_file_path = get_blob_storage_data(blob_service_client, partner, country_name)
+        # the part of the file prefix before the country code, e.g. processed/
+        folder = PARTNERS[partner]['file_prefix'].split('{')[0]
+        blobs_with_name = get_list_of_blobs(blob_service_client=blob_service_client,
+                                            container=f"coverage-data-{partner}", name_starts_with=folder)
+        country_codes = {re.split(r'[^a-zA-Z]', blob['name'].split('/')[-1])[0]
+                         for blob in blobs_with_name if blob['name'].endswith('.csv')}
+        partner_countries.append({convert_country(country_code, to='name_short') for country_code in country_codes})
+
+    return sorted(set.intersection(*partner_countries) - {'not found'})
 
-        if type(partner_df) == type(None):
-            return None, None
-        else:
-            partners_data_dict[partner] = {'data': partner_df, 'file_path': partner_file_path}
 
+def get_partner_data(blob_service_client: 'BlobServiceClient', country_name: str, 
+                     partners_list: list[str], spill_folder: str = None,
+                     partitions: int = 1) -> tuple[dict, 'pd.DataFrame | SpilledFrame']:
+    """
+    Fetches the latest file of every partner and the Giga master for a country concurrently. As soon as one partner
+    file turns out to be missing, the outstanding downloads are cancelled and (None, None) is returned
+
+    :param blob_service_client: The blob service client
+    :param country_name: The short name of the country
+    :param partners_list: The partners whose coverage files are required
+    :param spill_folder: When given, the files are spilled to this local folder as SpilledFrame instead of being read
+        into memory
+    :param partitions: The number of partitions the spilled rows are split into by giga_id_school
+    :returns: tuple[dict, pd.DataFrame | SpilledFrame]
+    """
     container_name = os.environ['DATA_CONTAINER_NAME']
-    master_df, _ = get_blob_storage_data(blob_service_client=blob_service_client, container_name=container_name, country_name=country_name)
+    cancel_event = threading.Event()
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=len(partners_list) + 1) as executor:
+        futures = {
+            executor.submit(get_blob_storage_data, blob_service_client=blob_service_client, container_name=partner,
+                            country_name=country_name, cancel_event=cancel_event, spill_folder=spill_folder,
+                            partitions=partitions): partner
+            for partner in partners_list
+        }
+        futures[executor.submit(get_blob_storage_data, blob_service_client=blob_service_client,
+                                container_name=container_name, country_name=country_name,
+                                cancel_event=cancel_event, spill_folder=spill_folder,
+                                partitions=partitions)] = container_name
+
+        try:
+            for future in as_completed(futures):
+                source = futures[future]
+                data_df, file_path = future.result()
+
+                if source in partners_list and type(data_df) == type(None):
+                    return None, None
+
+                results[source] = (data_df, file_path)
+        finally:
+            # stop the downloads still in flight when leaving early, the executor then waits for them to unwind
+            cancel_event.set()
+            for future in futures:
+                future.cancel()
+
+    partners_data_dict = {partner: {'data': results[partner][0], 'file_path': results[partner][1]}
+                          for partner in partners_list}
+    master_df, _ = results[container_name]
 
     return partners_data_dict, master_df
 
 
-def store_files(country_name, blob_service_client, facebook_df, itu_df, coverage_df, master_df):
+def store_files(country_name, blob_service_client, partner_file_paths, coverage_df, master_df):
         container_name = os.environ['DATA_CONTAINER_NAME']
         raw_coverage_folder = os.environ['RAW_COVERAGE_FOLDER']
         processed_coverage_folder = os.environ['PROCESSED_COVERAGE_FOLDER']
         master_file_folder = os.environ['MASTER_FILE_FOLDER']
 
         datetime_string = datetime.today().strftime('%Y%m%d_%H%M%S')
-        iso3_code = coco.convert(country_name, to='iso3')
-        facebook_file_path = f'{raw_coverage_folder}/facebook/{iso3_code}_coverage_data_{datetime_string}.csv'
-        itu_file_path = f'{raw_coverage_folder}/itu/{iso3_code}_coverage_data_{datetime_string}.csv'
-        coverage_file_path = f'{processed_coverage_folder}/{iso3_code}_school_geolocation_coverage_master.csv'
-        master_file_path = f'{master_file_folder}/{iso3_code}_school_geolocation_coverage_master.csv'
-
-        # upload different files to respective locations
-        upload_to_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=facebook_file_path,
-                              df=facebook_df)
-        upload_to_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=itu_file_path,
-                              df=itu_df)
-        upload_to_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=coverage_file_path,
-                              df=coverage_df, overwrite=True)
-        upload_to_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=master_file_path,
-                              df=master_df, overwrite=True)
-
-
-def delete_processed_partner_data(blob_service_client: BlobServiceClient, partners_data_dict: dict[dict[str, Any]]) -> None:
+        iso3_code = convert_country(country_name, to='iso3')
+
+        # the raw partner files are already in blob storage, so they are copied on the server side
+        copies = [
+            dict(source_container=f"coverage-data-{partner}", source_blob_path=partner_file_path,
+                 blob_file_path=f'{raw_coverage_folder}/{partner}/{iso3_code}_coverage_data_{datetime_string}.csv')
+            for partner, partner_file_path in partner_file_paths.items()
+        ]
+        uploads = []
+        for file_format in get_output_formats():
+            coverage_file_path = f'{processed_coverage_folder}/{iso3_code}_school_geolocation_coverage_master.{file_format}'
+            master_file_path = f'{master_file_folder}/{iso3_code}_school_geolocation_coverage_master.{file_format}'
+            uploads.append(dict(blob_file_path=coverage_file_path, df=coverage_df, overwrite=True, file_format=file_format))
+            uploads.append(dict(blob_file_path=master_file_path, df=master_df, overwrite=True, file_format=file_format))
+
+        # upload different files to respective locations concurrently
+        with ThreadPoolExecutor(max_workers=len(copies) + len(uploads)) as executor:
+            futures = [executor.submit(copy_blob, blob_service_client=blob_service_client, container=container_name,
+                                       **copy) for copy in copies]
+            futures += [executor.submit(upload_to_blob_client, blob_service_client=blob_service_client,
+                                        container=container_name, **upload) for upload in uploads]
+
+        for future in futures:
+            future.result()
+
+
+def get_output_formats() -> list[str]:
+    """
+    Reads the OUTPUT_FORMAT setting, a comma separated list of the formats the processed coverage and master files
+    are written in, e.g. "csv", "parquet" or "csv,parquet"
+
+    :returns: list[str]
+    """
+    output_formats = [file_format.strip().lower()
+                      for file_format in os.environ.get('OUTPUT_FORMAT', DEFAULT_OUTPUT_FORMAT).split(',')]
+
+    invalid_formats = [file_format for file_format in output_formats if file_format not in OUTPUT_FORMATS]
+    if invalid_formats:
+        raise ValueError(f'Invalid output format {invalid_formats} provided. Must be one of; {", ".join(OUTPUT_FORMATS)}')
+
+    return output_formats
+
+
+def delete_processed_partner_data(blob_service_client: 'BlobServiceClient', partners_data_dict: dict[dict[str, Any]]) -> None:
     for partner_name in partners_data_dict.keys():
         container_name = f"coverage-data-{partner_name}"
         file_path = partners_data_dict[partner_name]['file_path']
         delete_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=file_path)
 
 
-def get_blob_storage_data(blob_service_client: BlobServiceClient, container_name: str, country_name: str) -> pd.DataFrame:
-    if container_name == 'facebook':
-        container_name = f"coverage-data-{container_name}"
-        iso_code = coco.convert(country_name, to='ISO2').upper()
-        name_starts_with = f'processed/{iso_code}'
-    elif container_name == 'itu':
+def get_blob_storage_data(blob_service_client: 'BlobServiceClient', container_name: str, country_name: str,
+                          cancel_event: threading.Event = None, spill_folder: str = None,
+                          partitions: int = 1) -> 'pd.DataFrame | SpilledFrame':
+    source, container_name, blobs_with_name = find_source_blobs(blob_service_client=blob_service_client,
+                                                                container_name=container_name, country_name=country_name)
+    columns = source['columns']
+    schema = source['schema']
+
+    if not blobs_with_name:
+        logging.info(f'File from {container_name} for {country_name} not yet received')
+        return None, None
+
+    blob_name = select_source_blob(source, blobs_with_name)
+
+    # out of core, the rows are spilled to local files split into partitions instead of being kept in memory
+    spill = None
+    if spill_folder:
+        spill = SpilledFrame(folder=spill_folder, name=container_name, partitions=partitions)
+
+    validation_report = {}
+    if source.get('reads_parquet') and blob_name.endswith('.parquet'):
+        with measure_stage('read', container=container_name, blob=blob_name) as metrics:
+            # Parquet keeps its footer at the end of the file, so the chunks are downloaded before parsing starts,
+            # the download can still be cancelled between chunks
+            blob_stream = download_stream_from_blob_client(blob_service_client=blob_service_client,
+                                                           container=container_name, blob_file_path=blob_name,
+                                                           cancel_event=cancel_event)
+            try:
+                parquet_data = blob_stream.read()
+            except BlobDownloadError as e:
+                error_text = f"Error while fetching file: {blob_name} from container {container_name}"
+                send_slack_message(message=error_text)
+                raise
+            metrics['download_seconds'] = round(blob_stream.raw.fetch_seconds, 4)
+            metrics['bytes_downloaded'] = blob_stream.raw.bytes_read
+            if spill:
+                for chunk in read_parquet_columns_in_chunks(io.BytesIO(parquet_data), columns=columns):
+                    spill.append(apply_schema(chunk, schema=schema, validation_report=validation_report))
+                partner_df = spill
+            else:
+                partner_df = apply_schema(read_parquet_columns(io.BytesIO(parquet_data), columns=columns),
+                                          schema=schema, validation_report=validation_report)
+            metrics['rows'] = len(partner_df)
+        log_schema_validation(container_name, blob_name, validation_report)
+        return partner_df, blob_name
+
+    with measure_stage('read', container=container_name, blob=blob_name) as metrics:
+        blob_stream = download_stream_from_blob_client(blob_service_client=blob_service_client, container=container_name,
+                                                       blob_file_path=blob_name, cancel_event=cancel_event)
+        try:
+            partner_df = read_csv_in_chunks(blob_stream, columns=columns, schema=schema,
+                                            validation_report=validation_report, spill=spill)
+        except BlobDownloadError as e:
+            error_text = f"Error while fetching file: {blob_name} from container {container_name}"
+            send_slack_message(message=error_text)
+            raise
+        # the download is interleaved with parsing, the reader tracks the time spent waiting for chunks
+        metrics['download_seconds'] = round(blob_stream.raw.fetch_seconds, 4)
+        metrics['bytes_downloaded'] = blob_stream.raw.bytes_read
+        metrics['rows'] = len(partner_df)
+    log_schema_validation(container_name, blob_name, validation_report)
+    return partner_df, blob_name
+
+
+def select_source_blob(source: dict[str, Any], blobs_with_name: list[str]) -> str:
+    """
+    The file read from a source, the newest of its files. A source reading Parquet, like the master, has its newest
+    file read in either format, so a Parquet copy is only read while no newer CSV arrived. A copy stored at the same
+    time as its CSV is listed first, see find_latest_blobs. Other sources are always read as CSV
+
+    :param source: The source's entry in PARTNERS or MASTER_SOURCE
+    :param blobs_with_name: The names of the source's files, newest first
+    :returns: str
+    """
+    if source.get('reads_parquet'):
+        return blobs_with_name[0]
+
+    csv_blobs = [blob for blob in blobs_with_name if not blob.endswith('.parquet')]
+    return (csv_blobs or blobs_with_name)[0]
+
+
+def find_source_blobs(blob_service_client: 'BlobServiceClient', container_name: str,
+                      country_name: str) -> tuple[dict[str, Any], str, list[str]]:
+    """
+    Finds the files of a country from a partner or the Giga master, newest first
+
+    :param blob_service_client: The blob service client
+    :param container_name: A partner in PARTNERS or giga for the master
+    :param country_name: The short name of the country
+    :returns: tuple[dict[str, Any], str, list[str]], the source's entry in PARTNERS or MASTER_SOURCE, its container and
+        the names of its files
+    """
+    if container_name in PARTNERS:
+        source = PARTNERS[container_name]
         container_name = f"coverage-data-{container_name}"
-        iso_code = coco.convert(country_name, to='ISO3').lower()
-        name_starts_with = f'processed/{iso_code}'
     elif container_name == 'giga':
-        iso_code = coco.convert(country_name, to='ISO3').upper()
-        name_starts_with = f'gold/school_data/{iso_code}'
+        source = MASTER_SOURCE
     else:
-        Exception('Invalid container name provided. Must be one of; facebook, itu and giga')
+        raise ValueError(f'Invalid container name provided. Must be one of; {", ".join(PARTNERS_LIST)} and giga')
 
-    blobs_with_name = get_list_of_blobs(blob_service_client = blob_service_client, container=container_name, name_starts_with=name_starts_with)
-    blobs_with_name = [blob['name'] for blob in blobs_with_name]
+    iso2_code = convert_country(country_name, to='ISO2')
+    iso3_code = convert_country(country_name, to='ISO3')
+    name_starts_with = source['file_prefix'].format(ISO2=iso2_code.upper(), iso2=iso2_code.lower(),
+                                                    ISO3=iso3_code.upper(), iso3=iso3_code.lower())
 
-    try:
-        blob_name = blobs_with_name[0]
-    except IndexError:
-        logging.info(f'File from {container_name} for {country_name} not yet received')
-        return None, None
-    
-    partner_data = download_from_blob_client(blob_service_client=blob_service_client, container=container_name, blob_file_path=blob_name)
-    partner_df = pd.read_csv(io.BytesIO(partner_data))
-    return partner_df, blob_name
-    
+    with measure_stage('list_blobs', container=container_name, name_starts_with=name_starts_with) as metrics:
+        blobs_with_name = find_latest_blobs(blob_service_client=blob_service_client, container=container_name,
+                                            name_starts_with=name_starts_with)
+        metrics['blobs'] = len(blobs_with_name)
 
-def process_coverage_data(facebook_df: pd.DataFrame, itu_df: pd.DataFrame):
+    return source, container_name, blobs_with_name
 
-    # prepare Facebook data
-    facebook_df['2G_coverage'] = (facebook_df['percent_2G'] > 0)
-    facebook_df['3G_coverage'] = (facebook_df['percent_3G'] > 0)
-    facebook_df['4G_coverage'] = (facebook_df['percent_4G'] > 0)
 
-    # prepare ITU data
-    itu_df['2G_coverage'] = (itu_df['2G'] >= 1)
-    itu_df['3G_coverage'] = (itu_df['3G'] == 1)
-    itu_df['4G_coverage'] = (itu_df['4G'] == 1)
+def read_csv_in_chunks(stream: io.BufferedIOBase, columns: list[str], chunk_rows: int = None,
+                       schema: dict[str, str] = None, validation_report: dict[str, dict] = None,
+                       spill: 'SpilledFrame' = None) -> 'pd.DataFrame | SpilledFrame':
+    """
+    Parses a CSV stream in row chunks, keeping only the given columns, so that neither the raw file nor the unused
+    columns are ever held in memory at once. Columns missing from the file are ignored. Each chunk is converted to the
+    compact dtypes of the schema before the next one is parsed. The parsed frame is still held in memory, so the peak
+    is the frame plus about one chunk and its largest column, see concat_chunks. Spilled, only about one chunk is held
+
+    :param stream: A readable binary file object with the CSV content
+    :param columns: The columns to keep from the file
+    :param chunk_rows: The number of rows parsed at a time. Defaults to the CSV_READ_CHUNK_ROWS setting
+    :param schema: The compact dtype of each column, see apply_schema
+    :param validation_report: Collects the rows that do not fit the schema, see apply_schema
+    :param spill: When given, the chunks are appended to it instead of being concatenated in memory
+    :returns: pd.DataFrame, or the spill the chunks were appended to
+    """
+    if not chunk_rows:
+        chunk_rows = int(os.environ.get('CSV_READ_CHUNK_ROWS', DEFAULT_CSV_READ_CHUNK_ROWS))
 
-    itu_cols_to_rename = ['Schools_within_1km','Schools_within_2km', 'Schools_within_3km', 'Schools_within_10km']
-    itu_df = itu_df.rename(lambda col: col.lower() if col in itu_cols_to_rename else col, axis='columns')
+    columns_to_keep = set(columns)
+    chunks = pd.read_csv(stream, usecols=lambda column: column in columns_to_keep, chunksize=chunk_rows)
+    if schema:
+        chunks = (apply_schema(chunk, schema=schema, validation_report=validation_report) for chunk in chunks)
 
+    if type(spill) == type(None):
+        return concat_chunks(chunks)
 
-    fb_cols_to_keep = ['giga_id_school', '2G_coverage', '3G_coverage', '4G_coverage']
-    itu_cols_to_keep = ['giga_id_school', '2G_coverage', '3G_coverage', 'fiber_node_distance',
-                        'microwave_node_distance', 'nearest_school_distance', 'schools_within_1km', 'schools_within_2km',
-                        'schools_within_3km', 'schools_within_10km', 'nearest_LTE_id', 'nearest_LTE_distance',
-                        'nearest_UMTS_id', 'nearest_UMTS_distance', 'nearest_GSM_id', 'nearest_GSM_distance',
-                        '2G_coverage', '3G_coverage', '4G_coverage', 'pop_within_1km', 'pop_within_2km',
-                        'pop_within_3km', 'pop_within_10km']
-    
-    facebook_df = facebook_df.loc[facebook_df['giga_id_school'].notna(), fb_cols_to_keep]
-    itu_df = itu_df.loc[itu_df['giga_id_school'].notna(), [col for col in itu_cols_to_keep if col in itu_df.columns]]
-    
-    
-    # combine the coverage data
-    coverage_df = facebook_df.merge(itu_df, on='giga_id_school', suffixes=('', '_itu'), how='outer')
+    for chunk in chunks:
+        spill.append(chunk)
+    return spill
 
-    # harmonize the coverage columns
-    for column in ( '4G_coverage', '3G_coverage', '2G_coverage'):
-        coverage_df[f'{column}'] = coverage_df[[col for col in coverage_df.columns if col.startswith(column)]].any(
-            axis='columns')
 
-    coverage_df['coverage_type'] = np.select(
-        [coverage_df['4G_coverage'], coverage_df['3G_coverage'], coverage_df['2G_coverage']],
-        ['4G', '3G', '2G'],
-        default='no coverage'
-    )
+def concat_chunks(chunks: Iterable['pd.DataFrame'], dtypes: dict[str, Any] = None) -> 'pd.DataFrame':
+    """
+    Concatenates the row chunks of a frame, after converting every chunk to the common dtypes of all chunks, see
+    common_dtype. Columns that are categorical in every chunk stay categorical instead of falling back to object.
 
-    for column in ( '2G_coverage', '3G_coverage', '4G_coverage'):
-        coverage_df.loc[:, column] = coverage_df[column].map({True: 'YES', False: 'NO'})
+    Chunks from a generator are taken apart into columns as they come, and the frame is assembled one column at a time
+    releasing the column's chunks as it goes, so the peak memory is the concatenated frame plus its largest column and
+    one chunk. A list of chunks is already held by the caller and is concatenated as is
 
-    coverage_df['coverage_availability'] = np.where(coverage_df['coverage_type'] == 'no coverage', 'NO', 'YES')
+    :param chunks: The row chunks, all with the same columns
+    :param dtypes: The dtype of each column, by default the common dtypes of the chunks
+    :returns: pd.DataFrame
+    """
+    if isinstance(chunks, list):
+        chunk_dtypes = [chunk.dtypes for chunk in chunks]
+        if not dtypes:
+            dtypes = {column: common_dtype([dtypes[column] for dtypes in chunk_dtypes]) for column in chunks[0].columns}
 
-    # drop the unnecessary columns
-    coverage_df = coverage_df[[col for col in coverage_df.columns if not col.endswith('_itu')]]
+        converted_chunks = []
+        for chunk, chunk_dtypes in zip(chunks, chunk_dtypes):
+            changed_dtypes = {column: dtype for column, dtype in dtypes.items() if chunk_dtypes[column] != dtype}
+            converted_chunks.append(chunk.astype(changed_dtypes) if changed_dtypes else chunk)
 
-    return coverage_df
+        return pd.concat(converted_chunks, ignore_index=True)
 
+    column_chunks = {}
+    for chunk in chunks:
+        for column in chunk.columns:
+            # a copy, so the chunk's memory is not kept alive by a view on it
+            column_chunks.setdefault(column, []).append(chunk[column].copy())
+        del chunk
 
-def merge_coverage_and_master(master_df: pd.DataFrame, coverage_df: pd.DataFrame) -> pd.DataFrame:
+    columns = {}
+    for column in list(column_chunks):
+        parts = column_chunks.pop(column)
+        dtype = dtypes[column] if dtypes else common_dtype([part.dtype for part in parts])
+        columns[column] = pd.concat([part if part.dtype == dtype else part.astype(dtype) for part in parts],
+                                    ignore_index=True)
+        del parts
+
+    return pd.concat(columns, axis=1, copy=False)
+
+
+def common_dtype(dtypes: list[Any]) -> Any:
     """
-    Merges the processed coverage data with the school geolocation master data to create the full dataset for the
-    country. It also contains all the columns required in the full master dataset even if they may be empty
+    The dtype a column takes when chunks of it in the given dtypes are concatenated. Categoricals are combined into the
+    union of their categories, numbers into the smallest numeric type that holds all of them and anything else becomes
+    object. Unlike pd.concat, it does not depend on which chunks are empty or missing, so a frame concatenated from
+    any split of its chunks takes the same dtypes
 
-    :param master_df: The dataframe of the school geolocation master data
-    :param coverage_df: The dataframe of the processed coverage data
+    :param dtypes: The dtypes of the column in each chunk
+    :returns: The common dtype
+    """
+    if all(dtype == dtypes[0] for dtype in dtypes[1:]):
+        return dtypes[0]
+
+    if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+        return pd.CategoricalDtype(reduce(lambda left, right: left.union(right), [dtype.categories for dtype in dtypes]))
+
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in dtypes):
+        return np.result_type(*dtypes)
+
+    return np.dtype(object)
+
+
+def apply_schema(df: 'pd.DataFrame', schema: dict[str, str],
+                 validation_report: dict[str, dict] = None) -> 'pd.DataFrame':
+    """
+    Converts the columns of a frame to the compact dtypes of a schema; category, float32 or a numpy integer type.
+    Numeric columns only take their compact dtype if every value fits it exactly, so the written files do not change.
+    Otherwise the column keeps its parsed dtype and the rows that do not fit are counted in the validation report.
+    Columns parsed as floats, e.g. integer columns with missing values, are held as float32, and columns parsed as
+    integers stay integers
+
+    :param df: The frame, converted in place
+    :param schema: The compact dtype of each column. Columns missing from the frame are ignored
+    :param validation_report: Collects, per column, the declared dtype, the number of rows that do not fit and a few
+        example values
     :returns: pd.DataFrame
     """
-    master_df = master_df.merge(coverage_df, how='left', on='giga_id_school')
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+
+        if dtype == 'category':
+            df[column] = df[column].astype('category')
+            continue
+
+        values = pd.to_numeric(df[column], errors='coerce')
+        missing = values.isna()
+        if pd.api.types.is_integer_dtype(values.dtype):
+            # integer columns stay integers so that they are written the same, in the declared or the smallest type
+            compact_dtype = dtype if dtype != 'float32' else pd.to_numeric(values, downcast='integer').dtype
+            limits = np.iinfo(compact_dtype)
+            fits = values.between(limits.min, limits.max)
+        else:
+            compact_dtype = 'float32'
+            with np.errstate(over='ignore'):
+                fits = missing | (values.astype('float32').astype('float64') == values)
+        # values that are not numbers at all never fit
+        fits &= ~(missing & df[column].notna())
 
-    main_cols = ['giga_id_school', 'school_id', 'name', 'lat', 'lon', 'education_level',
-                 'education_level_regional', 'school_type',
-                 'connectivity', 'connectivity_speed', 'type_connectivity', 'coverage_availability', 'coverage_type',
-                 'latency_connectivity', 'admin1', 'admin2', 'admin3', 'admin4', 'school_region', 'num_computers',
-                 'num_teachers', 'num_students', 'num_classroom', 'computer_availability', 'computer_lab',
-                 'electricity', 'water',
-                 'address', 'fiber_node_distance', 'microwave_node_distance',
-                 'nearest_school_distance', 'schools_within_1km', 'schools_within_2km', 'schools_within_3km',
-                 'schools_within_10km', 'nearest_LTE_id', 'nearest_LTE_distance', 'nearest_UMTS_id',
-                 'nearest_UMTS_distance', 'nearest_GSM_id', 'nearest_GSM_distance', 'pop_within_1km', 'pop_within_2km',
-                 'pop_within_3km',
-                 'pop_within_10km']
+        if fits.all():
+            df[column] = values.astype(compact_dtype)
+        elif type(validation_report) != type(None):
+            column_report = validation_report.setdefault(column, {'dtype': dtype, 'rows': 0, 'examples': []})
+            column_report['rows'] += int((~fits).sum())
+            column_report['examples'] = (column_report['examples']
+                                         + df.loc[~fits, column].astype(str).head(3).tolist())[:3]
 
-    for column in main_cols:
-        if column not in master_df.columns:
-            master_df[column] = np.nan
+    return df
 
-    master_df = master_df[main_cols]
 
-    return master_df
-    
+def log_schema_validation(container_name: str, blob_name: str, validation_report: dict[str, dict]) -> None:
+    if validation_report:
+        log_structured('schema_validation', {'container': container_name, 'blob': blob_name,
+                                             'columns': validation_report})
+
 
-def send_slack_message(message: str, webhook: str = None) -> requests.Response:
-    """Send a Slack message to a channel via a webhook.
-    :param payload: Dictionary containing Slack message, i.e. {"text": "This is a test"}
-    :returns: HTTP response code, i.e. <Response [503]>
+def read_parquet_columns(source: io.BytesIO, columns: list[str]) -> 'pd.DataFrame':
     """
+    Reads only the given columns of a Parquet file. Columns missing from the file are ignored
 
-    if not webhook:
-        webhook = os.environ['SLACK_WEBHOOK']
+    :param source: A seekable binary file object with the Parquet content
+    :param columns: The columns to keep from the file
+    :returns: pd.DataFrame
+    """
+    import pyarrow.parquet as pq
 
-    payload = {"text": message}
+    parquet_file = pq.ParquetFile(source)
+    columns_to_read = [column for column in parquet_file.schema_arrow.names if column in set(columns)]
+    return parquet_file.read(columns=columns_to_read).to_pandas()
 
-    return requests.post(webhook, json.dumps(payload))
 
+def read_parquet_columns_in_chunks(source: io.BytesIO, columns: list[str],
+                                   chunk_rows: int = None) -> Iterator['pd.DataFrame']:
+    """
+    Reads only the given columns of a Parquet file, chunk_rows rows at a time. Columns missing from the file are ignored
 
-def create_blob_client():
-    connection_string = os.environ['saunigiga_STORAGE']
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    return blob_service_client
+    :param source: A seekable binary file object with the Parquet content
+    :param columns: The columns to keep from the file
+    :param chunk_rows: The number of rows read at a time. Defaults to the CSV_READ_CHUNK_ROWS setting
+    :returns: Iterator[pd.DataFrame]
+    """
+    import pyarrow.parquet as pq
 
+    if not chunk_rows:
+        chunk_rows = int(os.environ.get('CSV_READ_CHUNK_ROWS', DEFAULT_CSV_READ_CHUNK_ROWS))
 
-def download_from_blob_client(blob_service_client: BlobServiceClient, container, blob_file_path, local_file_path=None):
+    parquet_file = pq.ParquetFile(source)
+    columns_to_read = [column for column in parquet_file.schema_arrow.names if column in set(columns)]
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns_to_read):
+        yield batch.to_pandas()
 
-    try:
-        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
-        data = blob_client.download_blob().readall()
-    except Exception as e:
-        error_text = f"Error while fetching file: {blob_file_path} from container {container}"
-        send_slack_message(message=error_text)
-        raise
 
-    if not local_file_path:
-        return data
-    else:
-        with open(local_file_path, 'wb') as f:
-            f.write(data)
+def process_coverage_data(partner_dfs: dict[str, 'pd.DataFrame']) -> 'pd.DataFrame':
+    """
+    Combines the coverage data of the partners into one row per school and coverage source combination. The sources
+    are aligned on their encoded school ids once, carrying only row positions, after which each partner's coverage
+    flags, declared by its coverage rules in PARTNERS, and coverage columns are gathered in a single pass. The 2G, 3G
+    and 4G flags, coverage type and coverage availability are computed over NumPy boolean arrays and returned as
+    categorical columns
 
-    return local_file_path
+    :param partner_dfs: The dataframe of the coverage data of each partner in PARTNERS
+    :returns: pd.DataFrame
+    """
+    partner_dfs = {partner: partner_df.rename(columns=PARTNERS[partner]['renamed_columns'])
+                   for partner, partner_df in partner_dfs.items()}
+
+    partner_codes, school_id_dtype = school_id_codes(*partner_dfs.values())
+
+    # combine the coverage data on the encoded school ids, carrying the row position of each source instead of its
+    # data and leaving out the rows without a school id
+    position_frames = []
+    for partner, codes in zip(partner_dfs, partner_codes):
+        rows = np.flatnonzero(codes >= 0)
+        position_frames.append(pd.DataFrame({'_school_code': codes[rows], f'_{partner}_row': rows}))
+    coverage_df = reduce(lambda left, right: left.merge(right, on='_school_code', how='outer'), position_frames)
+
+    # pandas orders the schools of an outer merge by where they first appear before 2.2 and sorts them from 2.2 on, so
+    # the order is set here: schools by where they first appear in the partner files taken one after another, and the
+    # rows of a school by their row in each partner in turn, like the merges of the rows of the school
+    partner_rows = [np.arange(len(partner_df)) for partner_df in partner_dfs.values()]
+    partner_offsets = np.cumsum([0] + [len(partner_df) for partner_df in partner_dfs.values()][:-1])
+    school_positions = first_school_positions(partner_codes, partner_rows, partner_offsets,
+                                              len(school_id_dtype.categories))
+    row_keys = [coverage_df[f'_{partner}_row'].to_numpy(dtype='float64', na_value=np.nan) for partner in partner_dfs]
+    coverage_df = coverage_df.take(school_row_order(school_positions[coverage_df['_school_code'].to_numpy()], row_keys))
 
+    # harmonize the coverage columns
+    coverage_flags = np.zeros((len(coverage_df), len(COVERAGE_TECHNOLOGIES)), dtype=bool)
+    partner_columns = {}
+    for partner, partner_df in partner_dfs.items():
+        positions = coverage_df[f'_{partner}_row'].to_numpy(dtype='float64', na_value=np.nan)
+        coverage_flags |= take_rows(partner_coverage_flags(partner_df, PARTNERS[partner]['coverage_rules']), positions)
+
+        coverage_columns = [col for col in PARTNERS[partner]['coverage_columns'] if col in partner_df.columns]
+        if coverage_columns:
+            partner_columns.update(take_frame_rows(partner_df[coverage_columns], positions))
+    has_2g, has_3g, has_4g = coverage_flags.T
+
+    coverage_type_codes = np.select([has_4g, has_3g, has_2g], [2, 1, 0], default=3).astype(np.int8)
+    yes_no_columns = {f'{technology}_coverage': yes_no_categorical(coverage_flags[:, position])
+                      for position, technology in enumerate(COVERAGE_TECHNOLOGIES)}
+
+    coverage_df = pd.DataFrame({
+        'giga_id_school': pd.Categorical.from_codes(coverage_df['_school_code'].to_numpy(), dtype=school_id_dtype),
+        **yes_no_columns,
+        **partner_columns,
+        'coverage_type': pd.Categorical.from_codes(coverage_type_codes, categories=COVERAGE_TYPES),
+        'coverage_availability': yes_no_categorical(coverage_flags.any(axis=1)),
+    })
 
-def upload_to_blob_client(blob_service_client: BlobServiceClient, container: str, blob_file_path: str, df: pd.DataFrame,
-                          overwrite=False):
-    binary_data = df.to_csv(index=False).encode()
+    return coverage_df
 
-    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
-    upload_response = blob_client.upload_blob(binary_data, overwrite=overwrite)
-    return upload_response
 
-def delete_blob_client(blob_service_client: BlobServiceClient, container: str, blob_file_path: str):
-    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
-    delete_response = blob_client.delete_blob()
-    return delete_response
+def first_school_positions(partner_codes: list['np.ndarray'], partner_rows: list['np.ndarray'],
+                           partner_offsets: list[int], school_count: int) -> 'np.ndarray':
+    """
+    Position of the first row of every school when the partner files are taken one after another, -1 for schools
+    without rows
+
+    :param partner_codes: The school codes of the rows of each partner
+    :param partner_rows: The position of the rows in each partner's file
+    :param partner_offsets: The position of the first row of each partner when the partner files are taken together
+    :param school_count: The number of school codes
+    :returns: np.ndarray, indexed by school code
+    """
+    no_position = np.iinfo(np.int64).max
+    school_positions = np.full(school_count, no_position, dtype=np.int64)
+    for codes, rows, offset in zip(partner_codes, partner_rows, partner_offsets):
+        with_school_id = codes >= 0
+        np.minimum.at(school_positions, codes[with_school_id], offset + rows[with_school_id])
 
+    school_positions[school_positions == no_position] = -1
+    return school_positions
 
-def get_list_of_blobs(blob_service_client: BlobServiceClient, container: str, name_starts_with: str):
-    container_client = blob_service_client.get_container_client(container=container)
+
+def school_row_order(school_keys: 'np.ndarray', row_keys: list['np.ndarray']) -> 'np.ndarray':
+    """
+    Order of rows by the key of their school, then by each of the row keys in turn. Only the rows of schools with
+    several rows need the row keys, so they are sorted by them apart from the others
+
+    :param school_keys: The key of the school of every row, unique to the school
+    :param row_keys: The keys ordering the rows of a school, the first one first
+    :returns: np.ndarray, the positions of the rows in order
+    """
+    order = np.argsort(school_keys, kind='stable')
+
+    sorted_school_keys = school_keys[order]
+    repeated = np.zeros(len(order), dtype=bool)
+    repeated[1:] = sorted_school_keys[1:] == sorted_school_keys[:-1]
+    repeated[:-1] |= repeated[1:]
+
+    slots = np.flatnonzero(repeated)
+    rows = order[slots]
+    order[slots] = rows[np.lexsort([row_key[rows] for row_key in reversed(row_keys)] + [school_keys[rows]])]
+    return order
+
+
+def partner_coverage_flags(partner_df: 'pd.DataFrame',
+                           coverage_rules: dict[str, tuple[str, Callable, Any]]) -> 'np.ndarray':
+    """
+    Coverage flags of the rows of a partner, one column per technology in the order of COVERAGE_TECHNOLOGIES.
+    Technologies without a coverage rule are never covered
+    """
+    flags = np.zeros((len(partner_df), len(COVERAGE_TECHNOLOGIES)), dtype=bool)
+    for position, technology in enumerate(COVERAGE_TECHNOLOGIES):
+        if technology in coverage_rules:
+            column, compare, value = coverage_rules[technology]
+            flags[:, position] = compare(as_float_array(partner_df[column]), value)
+    return flags
+
+
+def as_float_array(series: 'pd.Series') -> 'np.ndarray':
+    return series.to_numpy(dtype='float64', na_value=np.nan)
+
+
+def take_rows(flags: 'np.ndarray', positions: 'np.ndarray') -> 'np.ndarray':
+    """
+    Gathers the flag rows at the given positions of a merged frame. Positions are NaN for rows without a match in
+    that source, which get no coverage
+    """
+    matched = ~np.isnan(positions)
+    rows = np.zeros((len(positions), flags.shape[1]), dtype=bool)
+    rows[matched] = flags[positions[matched].astype(np.intp)]
+    return rows
+
+
+def take_frame_rows(df: 'pd.DataFrame', positions: 'np.ndarray') -> 'pd.DataFrame':
+    """
+    Gathers the rows of a frame at the given positions of a merged frame, with empty values where the position is NaN
+    """
+    positions = np.nan_to_num(positions, nan=-1).astype(np.intp)
+    return df.reset_index(drop=True).reindex(positions).reset_index(drop=True)
+
+
+def yes_no_categorical(flags: 'np.ndarray') -> 'pd.Categorical':
+    return pd.Categorical.from_codes(flags.astype(np.int8), categories=YES_NO)
+
+
+def encode_school_ids(*frames: 'pd.DataFrame') -> list['pd.DataFrame']:
+    """
+    Encodes the giga_id_school column of all frames into a single categorical dtype, so the string ids are only hashed
+    once and every later join on them is a join on integer codes
+
+    :param frames: The dataframes with a giga_id_school column
+    :returns: list[pd.DataFrame], shallow copies of the frames with a categorical giga_id_school column
+    """
+    frame_codes, school_id_dtype = school_id_codes(*frames)
+
+    encoded_frames = []
+    for frame, codes in zip(frames, frame_codes):
+        frame = frame.copy(deep=False)
+        frame['giga_id_school'] = pd.Categorical.from_codes(codes, dtype=school_id_dtype)
+        encoded_frames.append(frame)
+
+    return encoded_frames
+
+
+def school_id_codes(*frames: 'pd.DataFrame') -> tuple[list['np.ndarray'], 'pd.CategoricalDtype']:
+    """
+    Returns the giga_id_school codes of every frame in one shared categorical dtype, -1 for missing ids. Frames already
+    encoded with encode_school_ids are reused as they are, otherwise the ids of all frames are factorized together.
+    Categories are sorted, so the codes order like the ids themselves
+
+    :param frames: The dataframes with a giga_id_school column
+    :returns: tuple[list[np.ndarray], pd.CategoricalDtype]
+    """
+    school_ids = [frame['giga_id_school'] for frame in frames]
+
+    shared_dtype = school_ids[0].dtype
+    if isinstance(shared_dtype, pd.CategoricalDtype) and all(ids.dtype == shared_dtype for ids in school_ids[1:]):
+        return [ids.cat.codes.to_numpy() for ids in school_ids], shared_dtype
+
+    codes, categories = pd.factorize(np.concatenate([ids.to_numpy(dtype=object) for ids in school_ids]), sort=True)
+    frame_codes = np.split(codes, np.cumsum([len(ids) for ids in school_ids])[:-1])
+    return frame_codes, pd.CategoricalDtype(categories)
+
+
+def incremental_processing_enabled() -> bool:
+    return os.environ.get('INCREMENTAL_PROCESSING', 'false').lower() == 'true'
+
+
+def process_coverage_data_incrementally(blob_service_client: 'BlobServiceClient', country_name: str,
+                                        partner_dfs: dict[str, 'pd.DataFrame'],
+                                        full: bool = False) -> tuple['pd.DataFrame', 'pd.DataFrame']:
+    """
+    Processes only the schools whose partner rows changed since the last run of the country, and patches them
+    into the coverage data of that run. Changes are found by comparing a content hash of the rows of every school with
+    the hashes kept in the country's coverage state. Without a state, or with one kept under other coverage rules or
+    partner columns, see coverage_rules_fingerprint, the whole country is processed.
+
+    Unchanged schools keep their position and changed or new schools are appended, so the row order can differ from a
+    full run
+
+    :param blob_service_client: The blob service client
+    :param country_name: The short name of the country
+    :param partner_dfs: The dataframe of the coverage data of each partner in PARTNERS
+    :param full: Whether all schools are processed without reading the stored state, which the new state replaces
+    :returns: tuple[pd.DataFrame, pd.DataFrame], the coverage data and the new coverage state to store with
+        store_coverage_state once the files are saved
+    """
+    partner_hashes = {partner: school_hashes(partner_df) for partner, partner_df in partner_dfs.items()}
+    school_ids = reduce(lambda left, right: left.union(right), [hashes.index for hashes in partner_hashes.values()])
+    current_hashes = pd.DataFrame({f'_{partner}_hash': hashes.reindex(school_ids, fill_value=0)
+                                   for partner, hashes in partner_hashes.items()})
+
+    previous_state_df = None
+    if not full:
+        previous_state_df = read_coverage_state(blob_service_client=blob_service_client, country_name=country_name)
+    rules_fingerprint = coverage_rules_fingerprint(
+        partner_columns={partner: list(partner_df.columns) for partner, partner_df in partner_dfs.items()})
+
+    if type(previous_state_df) != type(None) and (
+            COVERAGE_RULES_FINGERPRINT_COLUMN not in previous_state_df.columns or
+            (previous_state_df[COVERAGE_RULES_FINGERPRINT_COLUMN] != rules_fingerprint).any()):
+        logging.info(f'Coverage state for {country_name} was kept under other coverage rules or partner columns, '
+                     f'processing all schools')
+        previous_state_df = None
+
+    if type(previous_state_df) == type(None):
+        logging.info(f'No coverage state for {country_name}, processing all schools')
+        coverage_df = process_coverage_data(partner_dfs=partner_dfs)
+    else:
+        # a partner missing from the state, e.g. a newly added one, counts as changed for all of its schools
+        previous_hashes = previous_state_df.drop_duplicates('giga_id_school').set_index('giga_id_school')
+        previous_hashes = previous_hashes.reindex(columns=current_hashes.columns, fill_value=0).astype('uint64')
+        previous_hashes.index = previous_hashes.index.astype(object)
+
+        all_school_ids = school_ids.union(previous_hashes.index)
+        changed = (current_hashes.reindex(all_school_ids, fill_value=0)
+                   != previous_hashes.reindex(all_school_ids, fill_value=0)).any(axis='columns')
+        changed_school_ids = all_school_ids[changed.to_numpy()]
+        logging.info(f'{len(changed_school_ids)} of {len(school_ids)} schools changed for {country_name}')
+
+        coverage_delta_df = process_coverage_data(partner_dfs={
+            partner: partner_df.loc[partner_df['giga_id_school'].isin(changed_school_ids)]
+            for partner, partner_df in partner_dfs.items()})
+
+        unchanged_df = previous_state_df.loc[~previous_state_df['giga_id_school'].isin(changed_school_ids),
+                                             coverage_delta_df.columns]
+        # keep the school ids in the dtype shared by the sources, so later joins can reuse their codes
+        school_id_dtypes = [partner_df['giga_id_school'].dtype for partner_df in partner_dfs.values()]
+        school_id_dtype = school_id_dtypes[0]
+        if not isinstance(school_id_dtype, pd.CategoricalDtype) or any(
+                dtype != school_id_dtype for dtype in school_id_dtypes):
+            school_id_dtype = object
+        unchanged_df = unchanged_df.astype({'giga_id_school': school_id_dtype})
+        coverage_df = pd.concat([unchanged_df, coverage_delta_df], ignore_index=True)
+
+    coverage_state_df = coverage_df.join(current_hashes, on=coverage_df['giga_id_school'].astype(object))
+    coverage_state_df[COVERAGE_RULES_FINGERPRINT_COLUMN] = rules_fingerprint
+    return coverage_df, coverage_state_df
+
+
+def coverage_rules_fingerprint(partner_columns: dict[str, list[str]]) -> str:
+    """
+    Hash of everything deciding the processed coverage data of a school besides its partner rows: the partner registry
+    with its schemas and coverage rules, the columns of the partner files, which decide the coverage columns of every
+    school, the coverage types and COVERAGE_STATE_VERSION
+
+    :param partner_columns: The columns of the coverage data of each partner
+    :returns: str
+    """
+    coverage_rules = {'version': COVERAGE_STATE_VERSION, 'partners': PARTNERS,
+                      'partner_columns': {partner: sorted(map(str, columns))
+                                          for partner, columns in partner_columns.items()},
+                      'technologies': COVERAGE_TECHNOLOGIES, 'coverage_types': COVERAGE_TYPES, 'yes_no': YES_NO}
+    # the comparison operators of the coverage rules are serialized by name
+    serialized_rules = json.dumps(coverage_rules, sort_keys=True,
+                                  default=lambda value: getattr(value, '__name__', repr(value)))
+    return hashlib.sha256(serialized_rules.encode()).hexdigest()
+
+
+def school_hashes(df: 'pd.DataFrame') -> 'pd.Series':
+    """
+    Content hash of all rows of every school, indexed by giga_id_school. Rows without a school id are left out
+
+    :param df: The dataframe of a coverage source
+    :returns: pd.Series of uint64 hashes
+    """
+    (codes,), school_id_dtype = school_id_codes(df)
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+    school_rows = codes >= 0
+    hashes = pd.Series(row_hashes[school_rows]).groupby(codes[school_rows]).sum()
+    hashes.index = pd.Index(school_id_dtype.categories.take(hashes.index.to_numpy()), dtype=object,
+                            name='giga_id_school')
+    return hashes
+
+
+def get_coverage_state_path(country_name: str) -> str:
+    processed_coverage_folder = os.environ['PROCESSED_COVERAGE_FOLDER']
+    iso3_code = convert_country(country_name, to='iso3')
+    return f'{processed_coverage_folder}/state/{iso3_code}_coverage_state.parquet'
+
+
+def read_coverage_state(blob_service_client: 'BlobServiceClient', country_name: str) -> 'pd.DataFrame':
+    from azure.core.exceptions import ResourceNotFoundError
+
+    container_name = os.environ['DATA_CONTAINER_NAME']
+    blob_client = blob_service_client.get_blob_client(container=container_name,
+                                                      blob=get_coverage_state_path(country_name), snapshot=None)
+    try:
+        state_data = blob_client.download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+
+    return pd.read_parquet(io.BytesIO(state_data))
+
+
+def store_coverage_state(blob_service_client: 'BlobServiceClient', country_name: str,
+                         coverage_state_df: 'pd.DataFrame') -> None:
+    container_name = os.environ['DATA_CONTAINER_NAME']
+    upload_to_blob_client(blob_service_client=blob_service_client, container=container_name,
+                          blob_file_path=get_coverage_state_path(country_name), df=coverage_state_df, overwrite=True,
+                          file_format='parquet')
+
+
+def merge_coverage_and_master(master_df: 'pd.DataFrame', coverage_df: 'pd.DataFrame') -> 'pd.DataFrame':
+    """
+    Merges the processed coverage data with the school geolocation master data to create the full dataset for the
+    country. It also contains all the columns required in the full master dataset even if they may be empty
+
+    :param master_df: The dataframe of the school geolocation master data
+    :param coverage_df: The dataframe of the processed coverage data
+    :returns: pd.DataFrame
+    """
+    (master_codes, coverage_codes), _ = school_id_codes(master_df, coverage_df)
+
+    # join on the encoded school ids, carrying the row position of both frames
+    joined_rows = pd.DataFrame({'_school_code': master_codes, '_master_row': np.arange(len(master_codes))}).merge(
+        pd.DataFrame({'_school_code': coverage_codes, '_coverage_row': np.arange(len(coverage_codes))}),
+        how='left', on='_school_code')
+    # pandas only documents that a left merge keeps the order of the master rows, the coverage rows of a school are
+    # put in their order here, like process_coverage_data orders its rows itself
+    joined_rows = joined_rows.take(school_row_order(
+        joined_rows['_master_row'].to_numpy(), [joined_rows['_coverage_row'].to_numpy(dtype='float64', na_value=np.nan)]))
+
+    # like a merge, columns found in both frames are suffixed and so do not make it into the master columns
+    shared_columns = set(master_df.columns) & set(coverage_df.columns) - {'giga_id_school'}
+    master_columns = [col for col in master_df.columns if col not in shared_columns]
+    coverage_columns = [col for col in coverage_df.columns if col not in shared_columns and col != 'giga_id_school']
+
+    master_part = master_df[master_columns].take(joined_rows['_master_row'].to_numpy()).reset_index(drop=True)
+    coverage_part = take_frame_rows(coverage_df[coverage_columns],
+                                    joined_rows['_coverage_row'].to_numpy(dtype='float64', na_value=np.nan))
+
+    master_df = pd.concat([master_part, coverage_part], axis='columns').reindex(columns=MASTER_COLUMNS)
+
+    return master_df
+
+
+def get_out_of_core_partitions(blob_service_client: 'BlobServiceClient', country_name: str) -> int:
+    """
+    Number of partitions the coverage data of a country is processed in. When the memory its partner and master files
+    are estimated to need exceeds the OUT_OF_CORE_MEMORY_LIMIT setting, the country is split into enough partitions to
+    keep each under the limit. Otherwise, or without the setting, it is processed in memory as a single partition
+
+    :param blob_service_client: The blob service client
+    :param country_name: The short name of the country
+    :returns: int
+    """
+    memory_limit = int(os.environ.get('OUT_OF_CORE_MEMORY_LIMIT', DEFAULT_OUT_OF_CORE_MEMORY_LIMIT))
+    if not memory_limit:
+        return 1
+
+    estimated_memory = 0
+    for container_name in PARTNERS_LIST + [os.environ['DATA_CONTAINER_NAME']]:
+        source, container_name, blobs_with_name = find_source_blobs(blob_service_client=blob_service_client,
+                                                                    container_name=container_name,
+                                                                    country_name=country_name)
+        if not blobs_with_name:
+            # processed in memory, which reports the missing file
+            return 1
+
+        # the same file get_blob_storage_data reads
+        blob_name = select_source_blob(source, blobs_with_name)
+        file_format = 'parquet' if source.get('reads_parquet') and blob_name.endswith('.parquet') else 'csv'
+        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name, snapshot=None)
+        estimated_memory += blob_client.get_blob_properties().size * OUT_OF_CORE_MEMORY_PER_FILE_BYTE[file_format]
+
+    return max(1, math.ceil(estimated_memory / memory_limit))
+
+
+def process_country_coverage_out_of_core(blob_service_client: 'BlobServiceClient', country_name: str, partitions: int,
+                                         delete_partner_files: bool = True,
+                                         coordination_store: 'LocalCoordinationStore | BlobCoordinationStore' = None
+                                         ) -> str:
+    """
+    Runs the coverage workflow for a country too large to process in memory. The partner and master files are spilled
+    to a local folder, split into partitions by giga_id_school, and every partition is processed and merged on its own.
+    The stored files are streamed from the processed partitions and hold the same rows in the same order as those of
+    process_country_coverage. Incremental processing does not apply, all schools are processed
+
+    :param blob_service_client: The blob service client
+    :param country_name: The short name of the country
+    :param partitions: The number of partitions, see get_out_of_core_partitions
+    :param delete_partner_files: Whether the processed partner files are deleted once the files are stored
+    :param coordination_store: The store of the country's lease held for the run, if any, see check_lease
+    :returns: str, the outcome to report on Slack
+    """
+    with tempfile.TemporaryDirectory(prefix='coverage_', dir=os.environ.get('OUT_OF_CORE_FOLDER')) as spill_folder:
+        try:
+            with measure_stage('fetch', country=country_name, partitions=partitions):
+                partners_data_dict, master_spill = get_partner_data(blob_service_client, country_name,
+                                                                    partners_list=PARTNERS_LIST,
+                                                                    spill_folder=spill_folder, partitions=partitions)
+        except Exception as e:
+            error_text = f"Error while getting partner and master data for {country_name}:\n{traceback.format_exc()}"
+            send_slack_message(message=error_text)
+            raise
+
+        if type(partners_data_dict) == type(None):
+            return f"Coverage files not processed. Not enough partner data. At least 2 sources required\n"
+
+        try:
+            partner_file_paths = {partner: partners_data_dict[partner]['file_path'] for partner in PARTNERS_LIST}
+            with measure_stage('process', country=country_name, partitions=partitions) as metrics:
+                coverage_spill, master_with_coverage_spill = process_partitions(
+                    partner_spills={partner: partners_data_dict[partner]['data'] for partner in PARTNERS_LIST},
+                    master_spill=master_spill, spill_folder=spill_folder)
+                metrics['rows'] = len(coverage_spill)
+        except Exception as e:
+            error_text = f"Error while processing coverage data:\n{traceback.format_exc()}"
+            send_slack_message(message=error_text)
+            raise
+
+        try:
+            with measure_stage('store', country=country_name):
+                check_lease(coordination_store=coordination_store, country_name=country_name)
+                store_files(country_name=country_name, blob_service_client=blob_service_client,
+                            partner_file_paths=partner_file_paths, coverage_df=coverage_spill,
+                            master_df=master_with_coverage_spill)
+        except Exception as e:
+            error_text = f"Error while saving files:\n{traceback.format_exc()}"
+            send_slack_message(message=error_text)
+            raise
+
+    if not delete_partner_files:
+        return f"Coverage data has been processed and saved"
+
+    try:
+        with measure_stage('delete', country=country_name):
+            delete_processed_partner_data(blob_service_client=blob_service_client,
+                                          partners_data_dict=partners_data_dict)
+    except Exception as e:
+        error_text = f"Error while deleting files:\n{traceback.format_exc()}"
+        send_slack_message(message=error_text)
+        raise
+
+    return f"Coverage data has been processed and saved"
+
+
+def process_partitions(partner_spills: dict[str, 'SpilledFrame'], master_spill: 'SpilledFrame',
+                       spill_folder: str) -> tuple['SpilledFrame', 'SpilledFrame']:
+    """
+    Processes the coverage data and merges it into the master one partition at a time. All rows of a school are in the
+    same partition, so a partition is processed just like process_coverage_data and merge_coverage_and_master process
+    the whole country. Processed rows are spilled with their position in the whole country's output, so the stored
+    files can be streamed in the order the in memory workflow writes them
+
+    :param partner_spills: The spilled coverage data of each partner in PARTNERS
+    :param master_spill: The spilled school geolocation master data
+    :param spill_folder: The local folder the processed partitions are spilled to
+    :returns: tuple[SpilledFrame, SpilledFrame], the coverage data and the master with coverage data
+    """
+    partitions = master_spill.partitions
+    coverage_spill = SpilledFrame(folder=spill_folder, name='coverage', partitions=partitions,
+                                  order_column=SPILL_ORDER_COLUMN)
+    master_with_coverage_spill = SpilledFrame(folder=spill_folder, name='master_with_coverage', partitions=partitions,
+                                              order_column=SPILL_ORDER_COLUMN)
+
+    # the positions of the rows of each partner when the partner files are taken one after another in PARTNERS_LIST order
+    partner_offsets = dict(zip(PARTNERS_LIST, np.cumsum([0] + [len(partner_spills[partner])
+                                                               for partner in PARTNERS_LIST[:-1]])))
+
+    for partition in range(partitions):
+        with measure_stage('partition', partition=partition) as metrics:
+            *partner_dfs, master_df = encode_school_ids(
+                *[partner_spills[partner].read(partition) for partner in PARTNERS_LIST], master_spill.read(partition))
+            partner_dfs = dict(zip(PARTNERS_LIST, partner_dfs))
+
+            coverage_df = process_coverage_data(partner_dfs=partner_dfs)
+            coverage_spill.append_sorted(coverage_df, order=coverage_row_order(coverage_df, partner_dfs,
+                                                                               partner_offsets),
+                                         partition=partition)
+
+            master_with_coverage = merge_coverage_and_master(master_df=master_df, coverage_df=coverage_df)
+            master_with_coverage_spill.append_sorted(master_with_coverage,
+                                                     order=master_row_order(master_df, coverage_df),
+                                                     partition=partition)
+            metrics['rows'] = len(coverage_df)
+            metrics['master_rows'] = len(master_with_coverage)
+
+    return coverage_spill, master_with_coverage_spill
+
+
+def coverage_row_order(coverage_df: 'pd.DataFrame', partner_dfs: dict[str, 'pd.DataFrame'],
+                       partner_offsets: dict[str, int]) -> 'np.ndarray':
+    """
+    Positions of the rows of a partition's coverage data in the whole country's coverage data. process_coverage_data
+    orders schools by where they first appear in the partner files, taken one after another, and keeps the rows of a
+    school together in the same order in a partition, so the first partner row of its school orders a row
+
+    :param coverage_df: The coverage data of the partition
+    :param partner_dfs: The spilled coverage data of each partner in the partition, with the rows' positions in _row
+    :param partner_offsets: The position of the first row of each partner when the partner files are taken together
+    :returns: np.ndarray
+    """
+    (coverage_codes, *partner_codes), school_id_dtype = school_id_codes(coverage_df, *partner_dfs.values())
+
+    school_positions = first_school_positions(
+        partner_codes, [partner_df[SPILL_ROW_COLUMN].to_numpy() for partner_df in partner_dfs.values()],
+        [partner_offsets[partner] for partner in partner_dfs], len(school_id_dtype.categories))
+    return school_positions[coverage_codes]
+
+
+def master_row_order(master_df: 'pd.DataFrame', coverage_df: 'pd.DataFrame') -> 'np.ndarray':
+    """
+    Positions of the rows merge_coverage_and_master gives for a partition in the whole country's master. The merge
+    keeps the order of the master and repeats a school's master row for each of its coverage rows
+
+    :param master_df: The spilled master data of the partition, with the rows' positions in _row
+    :param coverage_df: The coverage data of the partition
+    :returns: np.ndarray
+    """
+    (master_codes, coverage_codes), school_id_dtype = school_id_codes(master_df, coverage_df)
+
+    coverage_rows = np.bincount(coverage_codes[coverage_codes >= 0], minlength=len(school_id_dtype.categories))
+    merged_rows = np.ones(len(master_codes), dtype=np.int64)
+    with_school_id = master_codes >= 0
+    merged_rows[with_school_id] = np.maximum(coverage_rows[master_codes[with_school_id]], 1)
+
+    return np.repeat(master_df[SPILL_ROW_COLUMN].to_numpy(), merged_rows)
+
+
+class SpilledFrame:
+    """
+    A frame kept on local storage as pickled row chunks instead of in memory. Its rows are split into partitions, the
+    rows of a file by the hash of their giga_id_school so all rows of a school end up in one partition, and processed
+    rows by the partition they were processed in. Partitions are read back in the dtypes the whole frame would have,
+    see common_dtype.
+
+    A frame with an order column keeps every partition sorted by it, and is read as a whole by merging the partitions
+    on it. It can then stand in for a dataframe in store_files, as it has the columns, dtypes, length, to_csv and
+    to_parquet that upload_to_blob_client and content_digest use
+    """
+
+    def __init__(self, folder: str, name: str, partitions: int = 1, order_column: str = None):
+        self.paths = [os.path.join(folder, f'{name}_{partition}.pickle') for partition in range(partitions)]
+        self.order_column = order_column
+        self.rows = 0
+        self._column_dtypes = {}
+        self._empty_df = None
+
+    @property
+    def partitions(self) -> int:
+        return len(self.paths)
+
+    @property
+    def columns(self) -> 'pd.Index':
+        return pd.Index([column for column in self._spilled_dtypes() if column != self.order_column])
+
+    @property
+    def dtypes(self) -> 'pd.Series':
+        return pd.Series({column: dtype for column, dtype in self._spilled_dtypes().items()
+                          if column != self.order_column}, dtype=object)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def append(self, df: 'pd.DataFrame', partition: int = None) -> None:
+        """
+        Appends rows to a partition. Without a partition, the rows are numbered with their position in the whole frame
+        in the _row column and split into partitions by the hash of their giga_id_school
+
+        :param df: The rows to append
+        :param partition: The partition to append to
+        """
+        if partition is None:
+            df = df.assign(**{SPILL_ROW_COLUMN: np.arange(self.rows, self.rows + len(df))})
+        # the categories of encoded school ids would hold every school of the country, which is what does not fit
+        if 'giga_id_school' in df.columns and isinstance(df['giga_id_school'].dtype, pd.CategoricalDtype):
+            df = df.astype({'giga_id_school': object})
+
+        for column, dtype in df.dtypes.items():
+            column_dtypes = self._column_dtypes.setdefault(column, [])
+            if dtype not in column_dtypes:
+                column_dtypes.append(dtype)
+        self.rows += len(df)
+
+        if partition is not None:
+            self._write(partition, df)
+            return
+
+        partition_ids = pd.util.hash_pandas_object(df['giga_id_school'], index=False).to_numpy() % self.partitions
+        positions = np.argsort(partition_ids, kind='stable')
+        bounds = np.searchsorted(partition_ids[positions], np.arange(self.partitions + 1))
+        for partition, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if end > start:
+                self._write(partition, df.take(positions[start:end]))
+
+    def append_sorted(self, df: 'pd.DataFrame', order: 'np.ndarray', partition: int) -> None:
+        """
+        Appends the rows processed in a partition, sorted by their position in the whole frame
+
+        :param df: The processed rows
+        :param order: The position of each row in the whole frame, kept in the order column
+        :param partition: The partition to append to
+        """
+        if not len(df):
+            # an empty partition does not decide the dtypes, unless every partition is empty
+            if type(self._empty_df) == type(None):
+                self._empty_df = df.assign(**{self.order_column: order})
+            return
+
+        positions = np.argsort(order, kind='stable')
+        df = df.take(positions).reset_index(drop=True)
+        df[self.order_column] = order[positions]
+
+        # the merge holds a chunk of every partition at once, which together make up about a chunk of rows
+        chunk_rows = max(1, int(os.environ.get('CSV_READ_CHUNK_ROWS', DEFAULT_CSV_READ_CHUNK_ROWS)) // self.partitions)
+        for start in range(0, len(df), chunk_rows):
+            self.append(df.iloc[start:start + chunk_rows], partition=partition)
+
+    def read(self, partition: int) -> 'pd.DataFrame':
+        """
+        Reads a partition into memory
+
+        :param partition: The partition to read
+        :returns: pd.DataFrame
+        """
+        dtypes = self._spilled_dtypes()
+        chunks = list(self._read_chunks(partition)) or [empty_frame(dtypes)]
+        return concat_chunks(chunks, dtypes=dtypes)
+
+    def iter_chunks(self) -> Iterator['pd.DataFrame']:
+        """
+        Reads the whole frame in chunks, merged from all partitions in the order of the order column, which is left out
+
+        :returns: Iterator[pd.DataFrame]
+        """
+        dtypes = self._spilled_dtypes()
+        partition_chunks = [self._read_chunks(partition) for partition in range(self.partitions)]
+        buffers = [next(chunks, None) for chunks in partition_chunks]
+
+        while any(type(buffer) != type(None) for buffer in buffers):
+            # rows up to the smallest last position in the buffers come first, as the rest of every partition is larger
+            bound = min(buffer[self.order_column].iat[-1] for buffer in buffers if type(buffer) != type(None))
+
+            merged_chunks = []
+            for partition, buffer in enumerate(buffers):
+                if type(buffer) == type(None):
+                    continue
+                end = np.searchsorted(buffer[self.order_column].to_numpy(), bound, side='right')
+                if end:
+                    merged_chunks.append(buffer.iloc[:end])
+                buffers[partition] = buffer.iloc[end:] if end < len(buffer) else next(partition_chunks[partition], None)
+
+            chunk = concat_chunks(merged_chunks, dtypes=dtypes)
+            chunk = chunk.take(np.argsort(chunk[self.order_column].to_numpy(), kind='stable'))
+            yield chunk.drop(columns=self.order_column).reset_index(drop=True)
+
+    def to_csv(self, path_or_buf: io.TextIOBase, index: bool = False) -> None:
+        for position, chunk in enumerate(self._iter_chunks_or_empty()):
+            chunk.to_csv(path_or_buf, index=index, header=position == 0)
+
+    def to_parquet(self, path: io.RawIOBase, index: bool = False, compression: str = None) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        parquet_writer = None
+        for chunk in self._iter_chunks_or_empty():
+            table = pa.Table.from_pandas(chunk, preserve_index=index,
+                                         schema=parquet_writer.schema if parquet_writer else None)
+            if not parquet_writer:
+                parquet_writer = pq.ParquetWriter(path, table.schema, compression=compression)
+            parquet_writer.write_table(table)
+        parquet_writer.close()
+
+    def _iter_chunks_or_empty(self) -> Iterator['pd.DataFrame']:
+        # an empty frame still writes its header
+        if not self.rows:
+            yield empty_frame(self.dtypes.to_dict())
+            return
+        yield from self.iter_chunks()
+
+    def _spilled_dtypes(self) -> dict[str, Any]:
+        if not self._column_dtypes and type(self._empty_df) != type(None):
+            return self._empty_df.dtypes.to_dict()
+        return {column: common_dtype(dtypes) for column, dtypes in self._column_dtypes.items()}
+
+    def _write(self, partition: int, df: 'pd.DataFrame') -> None:
+        with open(self.paths[partition], 'ab') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _read_chunks(self, partition: int) -> Iterator['pd.DataFrame']:
+        if not os.path.exists(self.paths[partition]):
+            return
+
+        with open(self.paths[partition], 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+def empty_frame(dtypes: dict[str, Any]) -> 'pd.DataFrame':
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+
+
+def log_structured(event_name: str, fields: dict[str, Any]) -> None:
+    """
+    Logs a record whose fields can be queried in Application Insights, both as JSON in the message and as custom
+    dimensions
+
+    :param event_name: The name of the record, e.g. import_timings
+    :param fields: JSON serializable fields of the record
+    """
+    logging.info(f'{event_name} {json.dumps(fields)}', extra={'custom_dimensions': {'event': event_name, **fields}})
+
+
+@contextmanager
+def measure_stage(stage: str, **fields: Any) -> Iterator[dict[str, Any]]:
+    """
+    Times a pipeline stage and logs it as a stage_metrics record with its wall time, whether it succeeded and the peak
+    RSS of the worker so far. The yielded dict takes further fields measured during the stage, e.g. rows or bytes
+
+    :param stage: The name of the stage, e.g. merge
+    :param fields: Fields known before the stage runs, e.g. the country
+    :returns: Iterator[dict[str, Any]]
+    """
+    metrics = dict(fields)
+    succeeded = False
+    start = time.perf_counter()
+    try:
+        yield metrics
+        succeeded = True
+    finally:
+        log_structured('stage_metrics', {'stage': stage, **metrics, 'succeeded': succeeded,
+                                         'seconds': round(time.perf_counter() - start, 4),
+                                         'peak_rss_bytes': peak_rss_bytes()})
+
+
+def peak_rss_bytes() -> int:
+    try:
+        import resource
+    except ImportError:
+        # resource is not available on Windows
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in kilobytes elsewhere
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+@contextmanager
+def profile_invocation(name: str) -> Iterator[None]:
+    """
+    Profiles the code run within the context when the PROFILE_INVOCATION setting names a profiler. cprofile dumps the
+    call statistics of the calling thread to a .prof file, tracemalloc dumps a snapshot of the memory allocated by all
+    threads to a .tracemalloc file. Both are written to the PROFILE_OUTPUT_FOLDER setting, and a summary of the top
+    entries is logged
+
+    :param name: The name of the profiled run, used as the prefix of the output file
+    :returns: Iterator[None]
+    """
+    profiler_name = os.environ.get('PROFILE_INVOCATION', '').strip().lower()
+    if not profiler_name:
+        yield
+        return
+
+    if profiler_name not in PROFILERS:
+        raise ValueError(f'Invalid profiler {profiler_name} provided. Must be one of; {", ".join(PROFILERS)}')
+
+    output_folder = os.environ.get('PROFILE_OUTPUT_FOLDER', tempfile.gettempdir())
+    output_path = os.path.join(output_folder, f"{name}_{datetime.today().strftime('%Y%m%d_%H%M%S')}")
+    summary = io.StringIO()
+
+    if profiler_name == 'cprofile':
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            output_path += '.prof'
+            profiler.dump_stats(output_path)
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+    else:
+        import tracemalloc
+
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            output_path += '.tracemalloc'
+            snapshot.dump(output_path)
+            for statistic in snapshot.statistics('lineno')[:PROFILE_SUMMARY_LINES]:
+                print(statistic, file=summary)
+
+    logging.info(f'{profiler_name} profile of {name} written to {output_path}\n{summary.getvalue()}')
+
+
+_reported_imports = set()
+_cold_start = True
+
+
+def log_import_timings() -> None:
+    """
+    Logs the time taken by the lazy imports of the heavy dependencies that ran during the invocation, similar to
+    python -X importtime for each dependency. The first invocation of a worker is flagged as the cold start
+    """
+    global _cold_start
+
+    imports = {module_name: round(seconds, 4) for module_name, seconds in IMPORT_TIMINGS.items()
+               if module_name not in _reported_imports}
+    _reported_imports.update(imports)
+
+    if imports or _cold_start:
+        log_structured('import_timings', {'cold_start': _cold_start, 'imports': imports,
+                                          'total_seconds': round(sum(imports.values()), 4)})
+    _cold_start = False
+
+
+@lru_cache(maxsize=None)
+def load_country_codes() -> dict[str, dict[str, str]]:
+    """
+    Loads the precomputed country code table, which was exported from country_converter, once per process. Every row
+    is indexed by its lower case short name, ISO2 and ISO3 code, and by the aliases in COUNTRY_CODE_ALIASES
+
+    :returns: dict[str, dict[str, str]]
+    """
+    country_codes = {}
+    with open(COUNTRY_CODES_FILE, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            for value in row.values():
+                country_codes[value.lower()] = row
+
+    for alias, iso3_code in COUNTRY_CODE_ALIASES.items():
+        country_codes[alias.lower()] = country_codes[iso3_code.lower()]
+
+    return country_codes
+
+
+@lru_cache(maxsize=None)
+def convert_country(country: str, to: str) -> str:
+    """
+    Converts a country short name, ISO2 or ISO3 code to another of these, like country_converter.convert. Lookups are
+    answered from the precomputed country code table and memoized, country_converter is only imported for values
+    missing from the table
+
+    :param country: The short name, ISO2 or ISO3 code of the country, in any case
+    :param to: One of name_short, ISO2 or ISO3, in any case
+    :returns: str
+    """
+    column = COUNTRY_CODE_COLUMNS[to.lower()]
+    row = load_country_codes().get(country.strip().lower())
+
+    if row:
+        return row[column]
+
+    import country_converter as coco
+    return coco.convert(country, to=column)
+
+
+def send_slack_message(message: str, webhook: str = None) -> None:
+    """Queue a Slack message for a channel's webhook. The message is sent in the background by the worker's notifier,
+    batched with the other messages queued at the same time; flush_slack_messages waits for it to be delivered
+    :param message: The text of the Slack message
+    :param webhook: The webhook of the channel, SLACK_WEBHOOK by default
+    """
+
+    if not webhook:
+        webhook = os.environ['SLACK_WEBHOOK']
+
+    get_slack_notifier().enqueue(message=message, webhook=webhook)
+
+
+def flush_slack_messages(timeout: float = None) -> bool:
+    """
+    Waits until the queued Slack messages have been sent, or dropped after their last attempt
+
+    :param timeout: The maximum time to wait in seconds, SLACK_FLUSH_TIMEOUT_SECONDS by default
+    :returns: bool, whether the queue was emptied in time
+    """
+    if timeout is None:
+        timeout = float(os.environ.get('SLACK_FLUSH_TIMEOUT_SECONDS', DEFAULT_SLACK_FLUSH_TIMEOUT_SECONDS))
+
+    with measure_stage('notify') as metrics:
+        flushed = get_slack_notifier().flush(timeout=timeout)
+        metrics['flushed'] = flushed
+
+    if not flushed:
+        logging.warning(f'Slack messages still queued after {timeout} seconds, they are sent in the background')
+
+    return flushed
+
+
+class SlackNotifier:
+    """
+    Queue of Slack messages sent by a background thread. The messages queued to a webhook within batch_seconds of each
+    other, or before a flush, are sent as one message. Each batch is posted with a timeout and tried again with
+    exponential backoff when the webhook cannot be reached, times out or answers 429 or 5xx
+    """
+
+    def __init__(self, timeout: float, max_attempts: int, backoff_seconds: float, batch_seconds: float):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.batch_seconds = batch_seconds
+        self._messages = []
+        self._sending = False
+        self._flush_requested = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, message: str, webhook: str) -> None:
+        with self._condition:
+            self._messages.append((webhook, message))
+            # the thread is gone in a forked worker process, e.g. of the backfill
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='slack-notifier', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def flush(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._messages or self._sending:
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    return False
+                self._condition.wait(remaining_seconds)
+
+        return True
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._messages:
+                    self._condition.wait()
+
+                batch_deadline = time.monotonic() + self.batch_seconds
+                while not self._flush_requested and time.monotonic() < batch_deadline:
+                    self._condition.wait(batch_deadline - time.monotonic())
+
+                messages, self._messages = self._messages, []
+                self._sending = True
+
+            batches = {}
+            for webhook, message in messages:
+                batches.setdefault(webhook, []).append(message)
+
+            try:
+                # an error posting to one webhook does not drop the batches of the other webhooks
+                for webhook, webhook_messages in batches.items():
+                    try:
+                        self.send_batch(webhook=webhook, messages=webhook_messages)
+                    except Exception:
+                        logging.error(f'Slack notifier failed to send {len(webhook_messages)} messages:\n'
+                                      f'{traceback.format_exc()}')
+            finally:
+                with self._condition:
+                    self._sending = False
+                    if not self._messages:
+                        self._flush_requested = False
+                    self._condition.notify_all()
+
+    def send_batch(self, webhook: str, messages: list[str]) -> bool:
+        """
+        Posts the messages to the webhook as one Slack message
+
+        :param webhook: The webhook of the channel
+        :param messages: The texts of the messages
+        :returns: bool, whether the webhook accepted the message
+        """
+        payload = {"text": SLACK_BATCH_SEPARATOR.join(messages)}
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = get_http_session().post(webhook, json.dumps(payload), timeout=self.timeout)
+                if response.status_code < 400:
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    logging.error(f'Slack webhook rejected {len(messages)} messages with HTTP '
+                                  f'{response.status_code}: {response.text}')
+                    return False
+                error = f'HTTP {response.status_code}'
+            except requests.RequestException as e:
+                error = repr(e)
+
+            if attempt < self.max_attempts:
+                backoff_seconds = self.backoff_seconds * 2 ** (attempt - 1)
+                logging.warning(f'Slack webhook attempt {attempt} of {self.max_attempts} failed ({error}), '
+                                f'trying again in {backoff_seconds} seconds')
+                time.sleep(backoff_seconds)
+
+        logging.error(f'Dropped {len(messages)} Slack messages after {self.max_attempts} attempts, last error {error}')
+        return False
+
+
+_blob_service_clients = {}
+_http_session = None
+_slack_notifier = None
+_clients_lock = threading.Lock()
+
+
+def reset_clients() -> None:
+    """
+    Drops the pooled clients and the Slack notifier of the worker, so they are created again on next use. A process
+    forked from a worker inherits them with the worker's open connections and queued messages, it calls this first
+    """
+    global _clients_lock, _http_session, _slack_notifier
+
+    # the lock may have been held by another thread of the worker when it was forked
+    _clients_lock = threading.Lock()
+    _blob_service_clients.clear()
+    _http_session = None
+    _slack_notifier = None
+
+
+def create_blob_client():
+    """
+    Returns the blob service client of the worker. It is created on first use and then reused by every invocation
+    the worker runs, together with its pool of open connections
+
+    :returns: BlobServiceClient
+    """
+    connection_string = os.environ['saunigiga_STORAGE']
+
+    with _clients_lock:
+        if connection_string not in _blob_service_clients:
+            from azure.core.pipeline.transport import RequestsTransport
+
+            chunk_size = int(os.environ.get('BLOB_READ_CHUNK_SIZE', DEFAULT_BLOB_READ_CHUNK_SIZE))
+            transport = RequestsTransport(session=create_http_session(), session_owner=False)
+            _blob_service_clients[connection_string] = azure_blob.BlobServiceClient.from_connection_string(
+                connection_string, max_single_get_size=chunk_size, max_chunk_get_size=chunk_size, transport=transport)
+
+    return _blob_service_clients[connection_string]
+
+
+def get_http_session() -> 'requests.Session':
+    """
+    Returns the HTTP session of the worker used for webhooks. It is created on first use and then reused by every
+    invocation the worker runs, together with its pool of open connections
+
+    :returns: requests.Session
+    """
+    global _http_session
+
+    with _clients_lock:
+        if _http_session is None:
+            _http_session = create_http_session()
+
+    return _http_session
+
+
+def create_http_session() -> 'requests.Session':
+    """
+    Creates an HTTP session whose connection pool holds HTTP_POOL_SIZE connections per host. Connections are kept
+    alive between requests unless HTTP_KEEP_ALIVE is false
+
+    :returns: requests.Session
+    """
+    pool_size = int(os.environ.get('HTTP_POOL_SIZE', DEFAULT_HTTP_POOL_SIZE))
+    keep_alive = os.environ.get('HTTP_KEEP_ALIVE', 'true').lower() == 'true'
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def get_slack_notifier() -> SlackNotifier:
+    """
+    Returns the Slack notifier of the worker. It is created on first use from the SLACK_TIMEOUT_SECONDS,
+    SLACK_MAX_ATTEMPTS, SLACK_RETRY_BACKOFF_SECONDS and SLACK_BATCH_SECONDS settings and then reused by every invocation
+
+    :returns: SlackNotifier
+    """
+    global _slack_notifier
+
+    with _clients_lock:
+        if _slack_notifier is None:
+            _slack_notifier = SlackNotifier(
+                timeout=float(os.environ.get('SLACK_TIMEOUT_SECONDS', DEFAULT_SLACK_TIMEOUT_SECONDS)),
+                max_attempts=int(os.environ.get('SLACK_MAX_ATTEMPTS', DEFAULT_SLACK_MAX_ATTEMPTS)),
+                backoff_seconds=float(os.environ.get('SLACK_RETRY_BACKOFF_SECONDS',
+                                                     DEFAULT_SLACK_RETRY_BACKOFF_SECONDS)),
+                batch_seconds=float(os.environ.get('SLACK_BATCH_SECONDS', DEFAULT_SLACK_BATCH_SECONDS)))
+
+    return _slack_notifier
+
+
+def download_from_blob_client(blob_service_client: 'BlobServiceClient', container, blob_file_path, local_file_path=None):
+
+    try:
+        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+        data = blob_client.download_blob().readall()
+    except Exception as e:
+        error_text = f"Error while fetching file: {blob_file_path} from container {container}"
+        send_slack_message(message=error_text)
+        raise
+
+    if not local_file_path:
+        return data
+    else:
+        with open(local_file_path, 'wb') as f:
+            f.write(data)
+
+    return local_file_path
+
+
+def download_stream_from_blob_client(blob_service_client: 'BlobServiceClient', container: str, blob_file_path: str,
+                                     cancel_event: threading.Event = None) -> io.BufferedReader:
+    """
+    Opens a blob for streaming reads. The blob is fetched in chunks of the client's max_chunk_get_size as the returned
+    file object is read, so only one chunk is held in memory at a time
+
+    :param blob_service_client: The blob service client
+    :param container: The container of the blob
+    :param blob_file_path: The path of the blob within the container
+    :param cancel_event: When set, reading stops with DownloadCancelledError before the next chunk is fetched
+    :returns: io.BufferedReader
+    """
+    try:
+        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+        downloader = blob_client.download_blob()
+    except Exception as e:
+        error_text = f"Error while fetching file: {blob_file_path} from container {container}"
+        send_slack_message(message=error_text)
+        raise
+
+    return io.BufferedReader(BlobChunkReader(downloader.chunks(), cancel_event=cancel_event))
+
+
+class DownloadCancelledError(Exception):
+    pass
+
+
+class BlobDownloadError(Exception):
+    """
+    Raised by BlobChunkReader when fetching the next chunk of a blob fails, so it can be told apart from errors of the
+    parser reading the stream
+    """
+
+
+class BlobChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of byte chunks, such as StorageStreamDownloader.chunks(). It counts the
+    bytes read and the time spent waiting for the next chunk
+    """
+
+    def __init__(self, chunks: Iterator[bytes], cancel_event: threading.Event = None):
+        self._chunks = chunks
+        self._cancel_event = cancel_event
+        self._current = memoryview(b'')
+        self.bytes_read = 0
+        self.fetch_seconds = 0.0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._current:
+            if self._cancel_event and self._cancel_event.is_set():
+                raise DownloadCancelledError('Blob download cancelled')
+            fetch_start = time.perf_counter()
+            try:
+                self._current = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            except Exception as e:
+                raise BlobDownloadError(f'Error while fetching the next chunk of the blob: {e}') from e
+            finally:
+                self.fetch_seconds += time.perf_counter() - fetch_start
+            self.bytes_read += len(self._current)
+
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+
+def upload_to_blob_client(blob_service_client: 'BlobServiceClient', container: str, blob_file_path: str,
+                          df: 'pd.DataFrame | SpilledFrame', overwrite=False, file_format: str = 'csv'):
+    """
+    Serializes a dataframe straight into staged blocks of a block blob, so that neither the full serialized file nor
+    an encoded copy of it is ever built. The blob only becomes visible once the whole frame was written and the block
+    list is committed. The content digest of the frame is kept in the blob's metadata, and a blob that may be
+    overwritten is left as is when its stored digest shows it already holds the same content
+
+    :param blob_service_client: The blob service client
+    :param container: The container to upload to
+    :param blob_file_path: The path of the blob within the container
+    :param df: The dataframe to upload, or a SpilledFrame whose chunks are written one after another
+    :param overwrite: Whether an existing blob may be replaced
+    :param file_format: Either csv or parquet. Parquet files are compressed with the PARQUET_COMPRESSION setting
+    :returns: The properties of the committed blob, or None when the blob was left unchanged
+    """
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+    compression = os.environ.get('PARQUET_COMPRESSION', DEFAULT_PARQUET_COMPRESSION)
+
+    with measure_stage('upload', container=container, blob=blob_file_path, rows=len(df)) as metrics:
+        digest = content_digest(df, file_format=file_format, compression=compression)
+        if overwrite and get_stored_content_digest(blob_client) == digest:
+            metrics['unchanged'] = True
+            return None
+
+        with BlobBlockWriter(blob_client) as block_writer:
+            if file_format == 'parquet':
+                df.to_parquet(block_writer, index=False, compression=compression)
+            else:
+                text_stream = io.TextIOWrapper(block_writer, encoding='utf-8', newline='', write_through=True)
+                df.to_csv(text_stream, index=False)
+                text_stream.flush()
+                text_stream.detach()
+            upload_response = block_writer.commit(overwrite=overwrite, metadata={CONTENT_DIGEST_METADATA_KEY: digest})
+            metrics['bytes_uploaded'] = block_writer.tell()
+
+    record_blob(container=container, blob_name=blob_file_path, etag=upload_response.get('etag'))
+
+    return upload_response
+
+
+class BlobBlockWriter(io.RawIOBase):
+    """
+    Write-only file object that stages everything written to it as blocks of a block blob. Blocks are staged in the
+    background while the caller keeps writing, with at most max_concurrency blocks in flight. Nothing is visible in
+    the blob until commit() is called
+    """
+
+    def __init__(self, blob_client: 'BlobClient', block_size: int = None, max_concurrency: int = None):
+        if not block_size:
+            block_size = int(os.environ.get('BLOB_UPLOAD_BLOCK_SIZE', DEFAULT_BLOB_UPLOAD_BLOCK_SIZE))
+        if not max_concurrency:
+            max_concurrency = int(os.environ.get('BLOB_UPLOAD_MAX_CONCURRENCY', DEFAULT_BLOB_UPLOAD_MAX_CONCURRENCY))
+
+        self._blob_client = blob_client
+        self._block_size = block_size
+        self._max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._buffer = bytearray()
+        self._block_ids = []
+        self._pending = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self._block_size:
+            self._stage(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _stage(self, block: bytes):
+        block_id = base64.b64encode(f'{len(self._block_ids):08d}'.encode()).decode()
+        self._block_ids.append(block_id)
+
+        # wait for the oldest block before queueing more, which bounds memory to max_concurrency blocks
+        while len(self._pending) >= self._max_concurrency:
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(self._blob_client.stage_block, block_id=block_id, data=block))
+
+    def commit(self, overwrite: bool = False, metadata: dict[str, str] = None) -> dict[str, Any]:
+        if self._buffer:
+            self._stage(bytes(self._buffer))
+            self._buffer.clear()
+
+        for future in self._pending:
+            future.result()
+        self._pending.clear()
+
+        if overwrite:
+            return self._blob_client.commit_block_list(self._block_ids, metadata=metadata)
+
+        from azure.core import MatchConditions
+        return self._blob_client.commit_block_list(self._block_ids, metadata=metadata,
+                                                   match_condition=MatchConditions.IfMissing)
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
+
+
+def content_digest(df: 'pd.DataFrame | SpilledFrame', file_format: str, compression: str = None) -> str:
+    """
+    Digest of the file a frame is written to; the format, pandas version, columns, dtypes and the hash of every row.
+    It is computed from the values rather than the serialized file, as serializing is the costly part of an upload
+
+    :param df: The dataframe to write, or a SpilledFrame standing in for one
+    :param file_format: Either csv or parquet
+    :param compression: The compression of Parquet files
+    :returns: str, a hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([file_format, compression if file_format == 'parquet' else None, pd.__version__,
+                              [str(column) for column in df.columns], [str(dtype) for dtype in df.dtypes]]).encode())
+    # the rows are hashed one by one, so a spilled frame is hashed a chunk at a time
+    for chunk in (df.iter_chunks() if isinstance(df, SpilledFrame) else [df]):
+        digest.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_stored_content_digest(blob_client: 'BlobClient') -> str:
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        return blob_client.get_blob_properties().metadata.get(CONTENT_DIGEST_METADATA_KEY)
+    except ResourceNotFoundError:
+        return None
+
+
+def copy_blob(blob_service_client: 'BlobServiceClient', source_container: str, source_blob_path: str, container: str,
+              blob_file_path: str) -> None:
+    """
+    Copies a blob within the storage account on the server side, without downloading or uploading its content, and
+    waits for the copy to finish
+
+    :param blob_service_client: The blob service client
+    :param source_container: The container of the blob to copy
+    :param source_blob_path: The path of the blob to copy within its container
+    :param container: The container to copy to
+    :param blob_file_path: The path of the copy within the container
+    """
+    source_blob_client = blob_service_client.get_blob_client(container=source_container, blob=source_blob_path,
+                                                             snapshot=None)
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+
+    with measure_stage('copy', container=container, blob=blob_file_path, source=source_blob_path):
+        copy_status = blob_client.start_copy_from_url(source_blob_client.url)['copy_status']
+        while copy_status == 'pending':
+            time.sleep(COPY_POLL_SECONDS)
+            copy_status = blob_client.get_blob_properties().copy.status
+
+    if copy_status != 'success':
+        raise RuntimeError(f'Copy of {source_blob_path} from container {source_container} to {blob_file_path} '
+                           f'ended with status {copy_status}')
+
+    record_blob(container=container, blob_name=blob_file_path)
+
+
+def delete_blob_client(blob_service_client: 'BlobServiceClient', container: str, blob_file_path: str):
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+    delete_response = blob_client.delete_blob()
+    record_blob(container=container, blob_name=blob_file_path, deleted=True)
+    return delete_response
+
+
+def get_list_of_blobs(blob_service_client: 'BlobServiceClient', container: str, name_starts_with: str):
+    container_client = blob_service_client.get_container_client(container=container)
     blob_names = container_client.list_blobs(name_starts_with=name_starts_with)
     return blob_names
+
+
+# cached listings of each container, by the prefix they were listed with
+_blob_index = {}
+_blob_index_lock = threading.Lock()
+
+
+def find_latest_blobs(blob_service_client: 'BlobServiceClient', container: str, name_starts_with: str) -> list[str]:
+    """
+    Names of the blobs starting with name_starts_with, newest first by last modified time and then by name. Listings
+    are cached per container and prefix for the BLOB_INDEX_TTL_SECONDS setting and kept up to date with the blobs of
+    the EventGrid events and the blobs the function uploads and deletes. A cached listing is only used once the ETag
+    of its newest blob has been confirmed, and prefixes without blobs are always listed again
+
+    :param blob_service_client: The blob service client
+    :param container: The container of the blobs
+    :param name_starts_with: The prefix of the blob names
+    :returns: list[str]
+    """
+    ttl_seconds = float(os.environ.get('BLOB_INDEX_TTL_SECONDS', DEFAULT_BLOB_INDEX_TTL_SECONDS))
+
+    with _blob_index_lock:
+        index_entry = _blob_index.get(container, {}).get(name_starts_with)
+        blobs = None
+        if index_entry and time.monotonic() - index_entry['listed_at'] < ttl_seconds:
+            blobs = dict(index_entry['blobs'])
+
+    if blobs:
+        latest_blob_name = max(blobs, key=lambda name: (blobs[name]['last_modified'], name))
+        if not blob_etag_matches(blob_service_client, container, latest_blob_name, blobs[latest_blob_name]['etag']):
+            blobs = None
+
+    if not blobs:
+        listed_blobs = get_list_of_blobs(blob_service_client=blob_service_client, container=container,
+                                         name_starts_with=name_starts_with)
+        blobs = {blob['name']: {'last_modified': blob['last_modified'].timestamp(), 'etag': blob['etag']}
+                 for blob in listed_blobs}
+        with _blob_index_lock:
+            _blob_index.setdefault(container, {})[name_starts_with] = {'blobs': dict(blobs),
+                                                                       'listed_at': time.monotonic()}
+
+    return sorted(blobs, key=lambda name: (blobs[name]['last_modified'], name), reverse=True)
+
+
+def blob_etag_matches(blob_service_client: 'BlobServiceClient', container: str, blob_name: str, etag: str) -> bool:
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_name, snapshot=None)
+        blob_properties = blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        return False
+
+    # blobs recorded without an ETag only need to exist
+    return not etag or blob_properties.etag == etag
+
+
+def record_blob(container: str, blob_name: str, etag: str = None, deleted: bool = False) -> None:
+    """
+    Adds a created or overwritten blob to the cached listings of its container, or removes a deleted one
+
+    :param container: The container of the blob
+    :param blob_name: The name of the blob within the container
+    :param etag: The ETag of the created blob, when known
+    :param deleted: Whether the blob was deleted
+    """
+    with _blob_index_lock:
+        for name_starts_with, index_entry in _blob_index.get(container, {}).items():
+            if not blob_name.startswith(name_starts_with):
+                continue
+            if deleted:
+                index_entry['blobs'].pop(blob_name, None)
+            else:
+                index_entry['blobs'][blob_name] = {'last_modified': time.time(), 'etag': etag}
@@ -0,0 +1,135 @@
+"""
+Reprocesses the coverage data of every country that has processed files from all partners, e.g. after the master schema
+or the harmonization rules changed. Countries are processed on a process pool and every finished country is written to
+a checkpoint file, so an interrupted backfill resumes where it stopped. Partner files are not deleted.
+
+It reads the same app settings as the function, run it from this folder:
+
+    python backfill.py --workers 4 --checkpoint backfill_checkpoint.json
+"""
+import argparse
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+import json
+import logging
+import os
+import traceback
+from typing import Callable
+
+import __init__
+
+
+def backfill_country(country_name: str) -> str:
+    """
+    Runs the coverage workflow for one country without deleting the partner files, processing every school whatever
+    the INCREMENTAL_PROCESSING setting. The country's lease is held for the run, so it never overlaps with a run
+    triggered by an event. Events that arrived during the run could not get the lease and left the country pending,
+    so it is then processed once more like those events would have
+
+    :param country_name: The short name of the country
+    :returns: str, the outcome of the run
+    """
+    blob_service_client = __init__.create_blob_client()
+    coordination_store = __init__.create_coordination_store(blob_service_client)
+
+    try:
+        if not coordination_store.acquire_lease(country_name):
+            raise RuntimeError(f'{country_name} is being processed by another run')
+
+        try:
+            outcome = __init__.process_country_coverage(blob_service_client=blob_service_client,
+                                                        country_name=country_name, delete_partner_files=False,
+                                                        incremental=False, coordination_store=coordination_store)
+        finally:
+            coordination_store.release_lease(country_name)
+
+        processing_results = {}
+        __init__.process_pending_country(
+            coordination_store, country_name, processing_results=processing_results,
+            process=lambda name: __init__.process_country_coverage(blob_service_client=blob_service_client,
+                                                                   country_name=name,
+                                                                   coordination_store=coordination_store))
+        if country_name in processing_results:
+            outcome += f'\nFiles received during the backfill: {processing_results[country_name].strip()}'
+        return outcome
+    finally:
+        # the worker process may exit once the country is done, so its error messages are sent before returning
+        __init__.flush_slack_messages()
+
+
+def load_checkpoint(checkpoint_path: str) -> dict[str, dict[str, str]]:
+    if not os.path.exists(checkpoint_path):
+        return {'completed': {}, 'failed': {}}
+
+    with open(checkpoint_path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict[str, dict[str, str]]) -> None:
+    # write to a temporary file first, so an interrupted backfill never leaves a truncated checkpoint
+    temporary_path = f'{checkpoint_path}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def run_backfill(country_names: list[str], checkpoint_path: str, max_workers: int,
+                 executor_factory: Callable[..., Executor] = ProcessPoolExecutor) -> dict[str, dict[str, str]]:
+    """
+    Backfills the given countries with at most max_workers countries processed at the same time. Countries completed
+    in an earlier run of the same checkpoint are skipped, failed ones are tried again
+
+    :param country_names: The short names of the countries
+    :param checkpoint_path: The path of the checkpoint file
+    :param max_workers: The number of countries processed at the same time
+    :param executor_factory: The executor class running the countries
+    :returns: dict[str, dict[str, str]], the checkpoint with the completed and failed countries
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    remaining_countries = [country_name for country_name in country_names
+                           if country_name not in checkpoint['completed']]
+    logging.info(f'Backfilling {len(remaining_countries)} countries, '
+                 f'{len(country_names) - len(remaining_countries)} already completed')
+
+    # forked workers start without the clients inherited from this process, which share its open connections
+    with executor_factory(max_workers=max_workers, initializer=__init__.reset_clients) as executor:
+        futures = {executor.submit(backfill_country, country_name): country_name
+                   for country_name in remaining_countries}
+
+        for finished_count, future in enumerate(as_completed(futures), start=1):
+            country_name = futures[future]
+            try:
+                checkpoint['completed'][country_name] = future.result()
+                checkpoint['failed'].pop(country_name, None)
+                logging.info(f'[{finished_count}/{len(futures)}] {country_name}: '
+                             f'{checkpoint["completed"][country_name].strip()}')
+            except Exception:
+                checkpoint['failed'][country_name] = traceback.format_exc()
+                logging.error(f'[{finished_count}/{len(futures)}] {country_name} failed:\n'
+                              f'{checkpoint["failed"][country_name]}')
+
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    return checkpoint
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of countries processed at the same time')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json',
+                        help='Checkpoint file recording the finished countries')
+    parser.add_argument('--countries', nargs='+',
+                        help='Short names or ISO codes of the countries to backfill, all countries by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.countries:
+        country_names = [__init__.convert_country(country, to='name_short') for country in args.countries]
+    else:
+        country_names = __init__.list_countries_with_partner_data(
+            blob_service_client=__init__.create_blob_client(), partners_list=__init__.PARTNERS_LIST)
+
+    checkpoint = run_backfill(country_names=country_names, checkpoint_path=args.checkpoint, max_workers=args.workers)
+    logging.info(f'Backfill finished, {len(checkpoint["completed"])} countries completed and '
+                 f'{len(checkpoint["failed"])} failed')
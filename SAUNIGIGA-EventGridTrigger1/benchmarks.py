@@ -0,0 +1,447 @@
+"""
+Benchmarks for the coverage pipeline on synthetic countries. They are not part of the test run, use pytest-benchmark
+to run them and store the results of the current commit, then compare later commits against them:
+
+    python -m pytest benchmarks.py --benchmark-autosave
+    python -m pytest benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+The country sizes are set with the BENCHMARK_SCHOOLS environment variable, a comma separated list of school counts.
+"""
+import copy
+from datetime import datetime, timezone
+import os
+import tracemalloc
+from types import SimpleNamespace
+
+import country_converter as coco
+import numpy as np
+import pandas as pd
+import pytest
+
+import __init__
+
+
+BENCHMARK_SCHOOLS = [int(n_schools) for n_schools in os.environ.get('BENCHMARK_SCHOOLS', '1000,100000,1000000').split(',')]
+
+
+class DiscardingBlobClient:
+    """
+    Stand-in for BlobClient and BlobServiceClient that accepts uploads without keeping them
+    """
+
+    def __init__(self):
+        self.bytes_uploaded = 0
+
+    def get_blob_client(self, container, blob, snapshot=None):
+        return self
+
+    def get_blob_properties(self):
+        # nothing is kept, so every upload writes a new blob
+        from azure.core.exceptions import ResourceNotFoundError
+        raise ResourceNotFoundError('The specified blob does not exist')
+
+    def upload_blob(self, data, overwrite=False):
+        self.bytes_uploaded += len(data)
+        return {}
+
+    def stage_block(self, block_id, data):
+        self.bytes_uploaded += len(data)
+
+    def commit_block_list(self, block_list, **kwargs):
+        return {}
+
+
+class InMemoryBlobServiceClient:
+    """
+    Stand-in for BlobServiceClient keeping the blobs in memory, so the download and upload paths can be timed end to
+    end without blob storage. Blobs are held in a dict of containers, each a dict of blob names to bytes, and every
+    write gets a new ETag
+    """
+
+    def __init__(self, blobs: dict[str, dict[str, bytes]] = None):
+        self.blobs = {}
+        self.blob_properties = {}
+        self.staged_blocks = {}
+        for container, container_blobs in (blobs or {}).items():
+            for blob, data in container_blobs.items():
+                self.write_blob(container, blob, data)
+
+    def write_blob(self, container, blob, data, metadata=None):
+        self.blobs.setdefault(container, {})[blob] = bytes(data)
+        self.blob_properties[(container, blob)] = {'last_modified': datetime.now(timezone.utc),
+                                                   'etag': f'"0x{len(self.blob_properties):x}"',
+                                                   'size': len(data), 'metadata': dict(metadata or {})}
+        return {'etag': self.blob_properties[(container, blob)]['etag']}
+
+    def get_blob_client(self, container, blob, snapshot=None):
+        return InMemoryBlobClient(self, container, blob)
+
+    def get_container_client(self, container):
+        return InMemoryContainerClient(self, container)
+
+
+class InMemoryContainerClient:
+
+    def __init__(self, service_client, container):
+        self._service_client = service_client
+        self._container = container
+
+    def list_blobs(self, name_starts_with=None):
+        blob_names = sorted(self._service_client.blobs.get(self._container, {}))
+        return [{'name': blob_name, **self._service_client.blob_properties[(self._container, blob_name)]}
+                for blob_name in blob_names if blob_name.startswith(name_starts_with or '')]
+
+
+class InMemoryBlobClient:
+
+    def __init__(self, service_client, container, blob):
+        self._service_client = service_client
+        self._container = container
+        self._blob = blob
+
+    @property
+    def url(self):
+        return f'memory://{self._container}/{self._blob}'
+
+    def _container_blobs(self):
+        return self._service_client.blobs.setdefault(self._container, {})
+
+    def upload_blob(self, data, overwrite=False):
+        from azure.core.exceptions import ResourceExistsError
+
+        if not overwrite and self._blob in self._container_blobs():
+            raise ResourceExistsError('BlobAlreadyExists')
+        return self._service_client.write_blob(self._container, self._blob, data)
+
+    def stage_block(self, block_id, data):
+        self._service_client.staged_blocks[(self._container, self._blob, block_id)] = bytes(data)
+
+    def commit_block_list(self, block_list, metadata=None, match_condition=None, **kwargs):
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError
+
+        if match_condition == MatchConditions.IfMissing and self._blob in self._container_blobs():
+            raise ResourceExistsError('BlobAlreadyExists')
+        return self._service_client.write_blob(self._container, self._blob, b''.join(
+            self._service_client.staged_blocks.pop((self._container, self._blob, block_id)) for block_id in block_list),
+            metadata=metadata)
+
+    def start_copy_from_url(self, source_url, **kwargs):
+        source_container, source_blob = source_url.removeprefix('memory://').split('/', 1)
+        self._service_client.write_blob(self._container, self._blob,
+                                        self._service_client.blobs[source_container][source_blob])
+        return {'copy_status': 'success'}
+
+    def get_blob_properties(self, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        if self._blob not in self._container_blobs():
+            raise ResourceNotFoundError('BlobNotFound')
+        return SimpleNamespace(**self._service_client.blob_properties[(self._container, self._blob)],
+                               copy=SimpleNamespace(status='success'))
+
+    def download_blob(self, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        if self._blob not in self._container_blobs():
+            raise ResourceNotFoundError('BlobNotFound')
+        return InMemoryDownloader(self._container_blobs()[self._blob])
+
+    def delete_blob(self, **kwargs):
+        del self._container_blobs()[self._blob]
+        del self._service_client.blob_properties[(self._container, self._blob)]
+
+
+class InMemoryDownloader:
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self.size = len(data)
+
+    def readall(self):
+        return self._data
+
+    def chunks(self):
+        chunk_size = int(os.environ.get('BLOB_READ_CHUNK_SIZE', __init__.DEFAULT_BLOB_READ_CHUNK_SIZE))
+        for start in range(0, len(self._data), chunk_size):
+            yield self._data[start:start + chunk_size]
+
+
+def make_school_ids(n_schools: int) -> np.ndarray:
+    return np.array([f'{i:08x}-7da7-4507-93e4-9f90aafd1ec5' for i in range(n_schools)], dtype=object)
+
+
+def add_duplicates_and_nulls(rng: np.random.Generator, school_ids: np.ndarray, duplicate_rate: float,
+                             null_rate: float) -> np.ndarray:
+    # repeat a share of the ids, shuffle them and blank out another share, as seen in partner and master files
+    school_ids = np.concatenate([school_ids, rng.choice(school_ids, size=int(len(school_ids) * duplicate_rate))])
+    rng.shuffle(school_ids)
+    school_ids[rng.random(len(school_ids)) < null_rate] = None
+    return school_ids
+
+
+def make_master_df(n_schools: int, duplicate_rate: float = 0.001, null_rate: float = 0.02,
+                   seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    school_ids = add_duplicates_and_nulls(rng, make_school_ids(n_schools), duplicate_rate, null_rate=0)
+    n_rows = len(school_ids)
+    master_df = pd.DataFrame({
+        'giga_id_school': school_ids,
+        'school_id': np.arange(n_rows),
+        'name': [f'school {i}' for i in range(n_rows)],
+        'lat': rng.uniform(-90, 90, n_rows),
+        'lon': rng.uniform(-180, 180, n_rows),
+        'education_level': rng.choice(['Primary', 'Secondary', 'Pre-Primary'], n_rows),
+        'admin1': np.where(rng.random(n_rows) < null_rate, None, rng.choice([f'region {i}' for i in range(30)], n_rows)),
+        'coverage_type': rng.choice(['2G', '3G', '4G', 'no coverage'], n_rows),
+        'coverage_availability': rng.choice(['YES', 'NO'], n_rows),
+    })
+    return master_df.reindex(columns=__init__.MASTER_COLUMNS)
+
+
+def upload_serialized_csv(blob_service_client, container, blob_file_path, df, overwrite=False):
+    # the upload path before staged block uploads, kept as the baseline
+    binary_data = df.to_csv(index=False).encode()
+    blob_client = blob_service_client.get_blob_client(container=container, blob=blob_file_path, snapshot=None)
+    return blob_client.upload_blob(binary_data, overwrite=overwrite)
+
+
+def peak_memory(function, *args, **kwargs) -> int:
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope='module', params=BENCHMARK_SCHOOLS, ids=lambda n_schools: f'{n_schools}_schools')
+def synthetic_country(request):
+    facebook_df, itu_df = make_partner_frames(request.param)
+    yield facebook_df, itu_df, make_master_df(request.param)
+
+
+@pytest.mark.parametrize('upload_function', [upload_serialized_csv, __init__.upload_to_blob_client],
+                         ids=['serialized', 'staged_blocks'])
+def test_master_upload(benchmark, synthetic_country, upload_function):
+    _, _, master_df = synthetic_country
+    blob_service_client = DiscardingBlobClient()
+    kwargs = dict(blob_service_client=blob_service_client, container='giga',
+                  blob_file_path='RWA_school_geolocation_coverage_master.csv', df=master_df, overwrite=True)
+
+    benchmark.extra_info['peak_memory_bytes'] = peak_memory(upload_function, **kwargs)
+    benchmark.pedantic(upload_function, kwargs=kwargs, rounds=3)
+
+
+def resolve_event_country_codes(convert, country_code='RWA'):
+    # the conversions made for one processed event; main, the three blob lookups and store_files
+    country_name = convert(country_code, to='name_short')
+    convert(country_name, to='ISO2')
+    convert(country_name, to='ISO3')
+    convert(country_name, to='ISO3')
+    convert(country_name, to='iso3')
+
+
+def convert_country_cold(country, to):
+    __init__.convert_country.cache_clear()
+    __init__.load_country_codes.cache_clear()
+    return __init__.convert_country(country, to=to)
+
+
+@pytest.mark.parametrize('convert', [coco.convert, convert_country_cold, __init__.convert_country],
+                         ids=['country_converter', 'lookup_table_cold', 'lookup_table_memoized'])
+def test_event_country_resolution(benchmark, convert):
+    benchmark(resolve_event_country_codes, convert)
+
+
+def process_coverage_data_legacy(facebook_df, itu_df):
+    # the harmonization before the single pass engine, kept as the baseline
+    facebook_df = facebook_df.copy()
+    itu_df = itu_df.copy()
+    facebook_df['2G_coverage'] = (facebook_df['percent_2G'] > 0)
+    facebook_df['3G_coverage'] = (facebook_df['percent_3G'] > 0)
+    facebook_df['4G_coverage'] = (facebook_df['percent_4G'] > 0)
+
+    itu_df['2G_coverage'] = (itu_df['2G'] >= 1)
+    itu_df['3G_coverage'] = (itu_df['3G'] == 1)
+    itu_df['4G_coverage'] = (itu_df['4G'] == 1)
+
+    itu_cols_to_rename = ['Schools_within_1km', 'Schools_within_2km', 'Schools_within_3km', 'Schools_within_10km']
+    itu_df = itu_df.rename(lambda col: col.lower() if col in itu_cols_to_rename else col, axis='columns')
+
+    fb_cols_to_keep = ['giga_id_school', '2G_coverage', '3G_coverage', '4G_coverage']
+    itu_cols_to_keep = ['giga_id_school', '2G_coverage', '3G_coverage'] + __init__.ITU_COVERAGE_COLUMNS + ['4G_coverage']
+
+    facebook_df = facebook_df.loc[facebook_df['giga_id_school'].notna(), fb_cols_to_keep]
+    itu_df = itu_df.loc[itu_df['giga_id_school'].notna(), [col for col in itu_cols_to_keep if col in itu_df.columns]]
+
+    coverage_df = facebook_df.merge(itu_df, on='giga_id_school', suffixes=('', '_itu'), how='outer')
+
+    for column in ('4G_coverage', '3G_coverage', '2G_coverage'):
+        coverage_df[f'{column}'] = coverage_df[[col for col in coverage_df.columns if col.startswith(column)]].any(
+            axis='columns')
+
+    coverage_df['coverage_type'] = np.select(
+        [coverage_df['4G_coverage'], coverage_df['3G_coverage'], coverage_df['2G_coverage']],
+        ['4G', '3G', '2G'],
+        default='no coverage'
+    )
+
+    for column in ('2G_coverage', '3G_coverage', '4G_coverage'):
+        coverage_df[column] = coverage_df[column].map({True: 'YES', False: 'NO'})
+
+    coverage_df['coverage_availability'] = np.where(coverage_df['coverage_type'] == 'no coverage', 'NO', 'YES')
+
+    return coverage_df[[col for col in coverage_df.columns if not col.endswith('_itu')]]
+
+
+def make_partner_frames(n_schools: int, partner_coverage: float = 0.9, duplicate_rate: float = 0.05,
+                        null_rate: float = 0.01, seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Generates facebook and ITU frames for a country of n_schools schools. Each partner covers its own random share of
+    the schools, repeats some of them and has missing school ids and coverage values
+
+    :param n_schools: The number of schools of the country
+    :param partner_coverage: The share of the schools in each partner file
+    :param duplicate_rate: The share of the rows repeated within each partner file
+    :param null_rate: The share of missing school ids and coverage values
+    :param seed: The seed of the random generator
+    :returns: tuple[pd.DataFrame, pd.DataFrame]
+    """
+    rng = np.random.default_rng(seed)
+    school_ids = make_school_ids(n_schools)
+
+    def partner_school_ids():
+        covered_ids = rng.choice(school_ids, size=int(n_schools * partner_coverage), replace=False)
+        return add_duplicates_and_nulls(rng, covered_ids, duplicate_rate, null_rate)
+
+    facebook_ids = partner_school_ids()
+    n_rows = len(facebook_ids)
+    facebook_df = pd.DataFrame({
+        'giga_id_school': facebook_ids,
+        'percent_2G': np.where(rng.random(n_rows) < null_rate, np.nan, rng.choice([0, 10, 50, 100], n_rows)),
+        'percent_3G': rng.choice([0, 0, 30, 80], n_rows),
+        'percent_4G': rng.choice([0, 0, 0, 60], n_rows),
+    })
+
+    itu_ids = partner_school_ids()
+    n_rows = len(itu_ids)
+    itu_df = pd.DataFrame({
+        'giga_id_school': itu_ids,
+        '2G': rng.choice([0, 1, 2], n_rows),
+        '3G': np.where(rng.random(n_rows) < null_rate, np.nan, rng.choice([0, 1], n_rows)),
+        '4G': rng.choice([0, 1], n_rows),
+        'fiber_node_distance': rng.uniform(0, 50, n_rows),
+        'Schools_within_1km': rng.integers(0, 10, n_rows),
+        'nearest_LTE_id': rng.integers(0, 10_000, n_rows),
+        'pop_within_1km': rng.integers(0, 5_000, n_rows),
+    })
+    return facebook_df, itu_df
+
+
+def process_coverage_data_registry(facebook_df, itu_df):
+    return __init__.process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
+
+
+@pytest.mark.parametrize('process_function', [process_coverage_data_legacy, process_coverage_data_registry],
+                         ids=['legacy', 'single_pass'])
+def test_process_coverage_data(benchmark, synthetic_country, process_function):
+    facebook_df, itu_df, _ = synthetic_country
+    benchmark.pedantic(process_function, args=(facebook_df, itu_df), rounds=3)
+
+
+def merge_coverage_and_master_legacy(master_df, coverage_df):
+    # the string keyed merge before the encoded school id join, kept as the baseline
+    master_df = master_df.merge(coverage_df, how='left', on='giga_id_school')
+    for column in __init__.MASTER_COLUMNS:
+        if column not in master_df.columns:
+            master_df[column] = np.nan
+    return master_df[__init__.MASTER_COLUMNS]
+
+
+def process_and_merge_legacy(facebook_df, itu_df, master_df):
+    coverage_df = process_coverage_data_legacy(facebook_df, itu_df)
+    return merge_coverage_and_master_legacy(master_df, coverage_df)
+
+
+def process_and_merge_encoded(facebook_df, itu_df, master_df):
+    facebook_df, itu_df, master_df = __init__.encode_school_ids(facebook_df, itu_df, master_df)
+    coverage_df = process_coverage_data_registry(facebook_df, itu_df)
+    return __init__.merge_coverage_and_master(master_df, coverage_df)
+
+
+@pytest.mark.parametrize('pipeline_function', [process_and_merge_legacy, process_and_merge_encoded],
+                         ids=['string_keys', 'encoded_keys'])
+def test_process_and_merge(benchmark, synthetic_country, pipeline_function):
+    args = synthetic_country
+
+    benchmark.extra_info['peak_memory_bytes'] = peak_memory(pipeline_function, *args)
+    benchmark.pedantic(pipeline_function, args=args, rounds=3)
+
+
+@pytest.mark.parametrize('rerun', [False, True], ids=['new_data', 'rerun'])
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_country_coverage_end_to_end(benchmark, synthetic_country, monkeypatch, output_format, rerun):
+    monkeypatch.setenv('DATA_CONTAINER_NAME', 'giga')
+    monkeypatch.setenv('RAW_COVERAGE_FOLDER', 'raw')
+    monkeypatch.setenv('PROCESSED_COVERAGE_FOLDER', 'processed')
+    monkeypatch.setenv('MASTER_FILE_FOLDER', 'master')
+    monkeypatch.setenv('OUTPUT_FORMAT', output_format)
+
+    facebook_df, itu_df, master_df = synthetic_country
+    blobs = {
+        'coverage-data-facebook': {'processed/RW_coverage.csv': facebook_df.to_csv(index=False).encode()},
+        'coverage-data-itu': {'processed/rwa_coverage.csv': itu_df.to_csv(index=False).encode()},
+        'giga': {'gold/school_data/RWA_school_geolocation_coverage_master.csv': master_df.to_csv(index=False).encode()},
+    }
+
+    # a fresh store every round, the raw partner copies may not be overwritten. A rerun starts from the store of a
+    # run that kept the partner files, so its outputs are unchanged
+    blob_service_client = InMemoryBlobServiceClient(blobs)
+    if rerun:
+        __init__.process_country_coverage(blob_service_client, 'Rwanda', delete_partner_files=False)
+
+    def setup():
+        return (), dict(blob_service_client=copy.deepcopy(blob_service_client), country_name='Rwanda')
+
+    benchmark.pedantic(__init__.process_country_coverage, setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize('partitions', [1, 4, 16])
+def test_country_coverage_out_of_core(benchmark, synthetic_country, monkeypatch, partitions):
+    monkeypatch.setenv('DATA_CONTAINER_NAME', 'giga')
+    monkeypatch.setenv('RAW_COVERAGE_FOLDER', 'raw')
+    monkeypatch.setenv('PROCESSED_COVERAGE_FOLDER', 'processed')
+    monkeypatch.setenv('MASTER_FILE_FOLDER', 'master')
+    monkeypatch.setenv('OUTPUT_FORMAT', 'csv')
+    # a single partition is the in memory workflow
+    monkeypatch.setattr(__init__, 'get_out_of_core_partitions', lambda blob_service_client, country_name: partitions)
+
+    facebook_df, itu_df, master_df = synthetic_country
+    blobs = {
+        'coverage-data-facebook': {'processed/RW_coverage.csv': facebook_df.to_csv(index=False).encode()},
+        'coverage-data-itu': {'processed/rwa_coverage.csv': itu_df.to_csv(index=False).encode()},
+        'giga': {'gold/school_data/RWA_school_geolocation_coverage_master.csv': master_df.to_csv(index=False).encode()},
+    }
+    blob_service_client = InMemoryBlobServiceClient(blobs)
+
+    def stored_files(client):
+        return {blob: data for blob, data in client.blobs['giga'].items()
+                if blob.startswith(os.environ['PROCESSED_COVERAGE_FOLDER']) or
+                blob.startswith(os.environ['MASTER_FILE_FOLDER'])}
+
+    with monkeypatch.context() as in_memory:
+        in_memory.setattr(__init__, 'get_out_of_core_partitions', lambda blob_service_client, country_name: 1)
+        in_memory_client = copy.deepcopy(blob_service_client)
+        __init__.process_country_coverage(in_memory_client, 'Rwanda', delete_partner_files=False)
+
+    clients = []
+
+    def setup():
+        clients.append(copy.deepcopy(blob_service_client))
+        return (), dict(blob_service_client=clients[-1], country_name='Rwanda', delete_partner_files=False)
+
+    benchmark.extra_info['peak_memory_bytes'] = peak_memory(__init__.process_country_coverage, *setup()[1].values())
+    benchmark.pedantic(__init__.process_country_coverage, setup=setup, rounds=3)
+
+    assert stored_files(clients[-1]) == stored_files(in_memory_client)
@@ -1,16 +1,28 @@
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import io
+import operator
+import os
+import subprocess
+import sys
+import threading
+import time
 
 import azure.functions as func
 from azure.storage.blob import BlobServiceClient
 import pandas as pd
-from pandas.testing import assert_series_equal
+from pandas.testing import assert_frame_equal, assert_series_equal
 import pytest
 
 import __init__
 from __init__ import main, process_coverage_data, merge_coverage_and_master
 
 
+@pytest.fixture(autouse=True)
+def empty_blob_index(mocker):
+    mocker.patch('__init__._blob_index', {})
+
+
 @pytest.fixture
 def unprocessed_data_url():
     blob_url = 'https://saunigiga.blob.core.windows.net/coverage-data-facebook/unprocessed/RWA_school_geolocation_unprocessed.csv'
@@ -113,6 +125,55 @@ def master_df():
     yield master_df
 
 
+@pytest.fixture
+def stand_in_server():
+    """
+    Local HTTP server standing in for the Slack webhook and blob storage. It answers every request with success, 202
+    for deletes and 200 otherwise, and records the method, path, client port, body and arrival time of each request.
+    Latency and failures are simulated by appending (delay in seconds, status code) pairs to the scripted responses,
+    which answer the next requests in order
+    """
+    received_requests = []
+    scripted_responses = []
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def handle_request(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            received_requests.append({'method': self.command, 'path': self.path, 'port': self.client_address[1],
+                                      'body': body, 'received_at': time.monotonic()})
+            delay_seconds, status = (scripted_responses.pop(0) if scripted_responses
+                                     else (0, 202 if self.command == 'DELETE' else 200))
+            time.sleep(delay_seconds)
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        do_DELETE = do_GET = do_HEAD = do_POST = do_PUT = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    # the client hangs up on responses slower than its timeout
+    server.handle_error = lambda request, client_address: None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}', received_requests, scripted_responses
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pooled_clients(mocker):
+    mocker.patch.object(__init__, '_http_session', None)
+    mocker.patch.object(__init__, '_slack_notifier', None)
+    mocker.patch.object(__init__, '_blob_service_clients', {})
+
+
 def test_file_added_to_unprocessed_folder(partner_event_unprocessed, mocker):
     slack_mock = mocker.patch('__init__.send_slack_message', return_value=200)
     main(partner_event_unprocessed)
@@ -129,6 +190,7 @@ def test_file_added_to_processed_folder_one_partner_available(partner_event_proc
     slack_mock = mocker.patch('__init__.send_slack_message', return_value=200)
     partner_data_mock = mocker.patch('__init__.get_partner_data', return_value=(None, None))
     blob_client_mock = mocker.patch('__init__.create_blob_client', return_value ="Client")
+    mocker.patch('__init__.create_coordination_store', return_value=__init__.LocalCoordinationStore())
     blob_data = "school_id,lat,lon\n1234,4.32,5.13"
     blob_path = "itu/processed/RWA_processed.csv"
 
@@ -150,6 +212,7 @@ def test_file_added_to_processed_all_files_available(partner_event_processed, fa
     slack_mock = mocker.patch('__init__.send_slack_message', return_value=200)
     partner_data_mock = mocker.patch('__init__.get_partner_data', return_value=(partner_data_dict, master_df))
     blob_client_mock = mocker.patch('__init__.create_blob_client', return_value ="Client")
+    mocker.patch('__init__.create_coordination_store', return_value=__init__.LocalCoordinationStore())
     store_files_mock = mocker.patch('__init__.store_files', return_value=None)
     delete_data_mock = mocker.patch('__init__.delete_processed_partner_data', return_value=None)
 
@@ -171,16 +234,933 @@ def test_file_added_to_processed_all_files_available(partner_event_processed, fa
 
 
 def test_coverage_data_creation(facebook_df, itu_df):
-    coverage_df = process_coverage_data(facebook_df=facebook_df, itu_df=itu_df)
-    coverage_type_series = pd.Series(data=['4G', '3G', '4G'], name='coverage_type')
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
+    coverage_type_series = pd.Series(data=pd.Categorical(['4G', '3G', '4G'], categories=__init__.COVERAGE_TYPES),
+                                     name='coverage_type')
     assert_series_equal(coverage_type_series, coverage_df['coverage_type'])
 
-    coverage_availability_series = pd.Series(data=['YES', 'YES', 'YES'],name='coverage_availability')
+    coverage_availability_series = pd.Series(data=pd.Categorical(['YES', 'YES', 'YES'], categories=__init__.YES_NO),
+                                             name='coverage_availability')
     assert_series_equal(coverage_availability_series, coverage_df['coverage_availability'])
 
+    assert coverage_df['2G_coverage'].tolist() == ['YES', 'YES', 'YES']
+    assert coverage_df['4G_coverage'].tolist() == ['YES', 'NO', 'YES']
+
+
+def test_coverage_data_creation_unmatched_schools(facebook_df, itu_df):
+    itu_df.loc[0, 'giga_id_school'] = 'b7b8d2a4-6f07-4dd2-9b1e-4b1f0a8e5a11'
+    itu_df.loc[0, '4G'] = 0
+    facebook_df.loc[1, 'giga_id_school'] = None
+
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
+
+    assert coverage_df['giga_id_school'].tolist() == [facebook_df.loc[0, 'giga_id_school'],
+                                                      facebook_df.loc[2, 'giga_id_school'],
+                                                      itu_df.loc[0, 'giga_id_school'],
+                                                      itu_df.loc[1, 'giga_id_school']]
+    assert coverage_df['coverage_type'].tolist() == ['4G', '4G', '3G', '3G']
+    assert 'percent_2G' in facebook_df.columns and '2G_coverage' not in facebook_df.columns
+
+
+def test_coverage_data_orders_schools_by_first_appearance():
+    facebook_df = pd.DataFrame({'giga_id_school': ['s-9', 's-1', 's-9'], 'percent_2G': [10, 0, 20],
+                                'percent_3G': [0, 0, 0], 'percent_4G': [0, 0, 0]})
+    itu_df = pd.DataFrame({'giga_id_school': ['s-5', 's-9', 's-1', 's-1'], '2G': [1, 0, 0, 1], '3G': [0, 1, 0, 0],
+                           '4G': [0, 0, 0, 0]})
+
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
+
+    assert coverage_df['giga_id_school'].tolist() == ['s-9', 's-9', 's-1', 's-1', 's-5']
+    assert coverage_df['coverage_type'].tolist() == ['3G', '3G', 'no coverage', '2G', '2G']
+
 
 def test_master_coverage_merge(facebook_df, itu_df, master_df):
-    coverage_df = process_coverage_data(facebook_df=facebook_df, itu_df=itu_df)
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
     merged_master_df = merge_coverage_and_master(master_df=master_df, coverage_df=coverage_df)
 
     assert merged_master_df.shape[0] == master_df.shape[0]
+
+
+def test_master_coverage_merge_keeps_master_and_coverage_row_order():
+    master_df = pd.DataFrame({'giga_id_school': ['s-9', 's-1', 's-5'], 'school_id': [1, 2, 3]})
+    coverage_df = pd.DataFrame({'giga_id_school': ['s-1', 's-9', 's-1'], 'coverage_type': ['2G', '4G', '3G']})
+
+    master_with_coverage = merge_coverage_and_master(master_df, coverage_df)
+
+    assert master_with_coverage['school_id'].tolist() == [1, 2, 2, 3]
+    assert master_with_coverage['coverage_type'].fillna('').tolist() == ['4G', '2G', '3G', '']
+
+
+def test_chunked_csv_read_keeps_only_requested_columns():
+    csv_data = b"giga_id_school,percent_2G,percent_3G,percent_4G,unused\n" \
+               b"aafa9d5e-7da7-4507-93e4-9f90aafd1ec5,90,40,30,x\n" \
+               b"308eb4aa-0fd9-4a4c-84d7-fb2d8e97c699,80,30,0,y\n" \
+               b"a428103f-8edd-45ae-8bad-17766f6fe887,10,0,5,z\n"
+    chunks = iter([csv_data[i:i + 7] for i in range(0, len(csv_data), 7)])
+    stream = io.BufferedReader(__init__.BlobChunkReader(chunks))
+
+    partner_df = __init__.read_csv_in_chunks(stream, columns=__init__.FACEBOOK_COLUMNS, chunk_rows=2)
+
+    expected_df = pd.read_csv(io.BytesIO(csv_data)).drop(columns='unused')
+    assert_frame_equal(expected_df, partner_df)
+
+
+def test_get_blob_storage_data_streams_latest_blob(mocker):
+    csv_data = b"giga_id_school,school_id,name,unused\nabc,1,one,x\n"
+    blob_service_client = mocker.MagicMock()
+    blob_service_client.get_container_client.return_value.list_blobs.return_value = [
+        {'name': 'gold/school_data/RWA.csv', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x1"'}]
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.chunks.return_value = iter([csv_data])
+
+    master_df, blob_name = __init__.get_blob_storage_data(blob_service_client, 'giga', 'Rwanda')
+
+    assert blob_name == 'gold/school_data/RWA.csv'
+    assert list(master_df.columns) == ['giga_id_school', 'school_id', 'name']
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.readall.assert_not_called()
+
+
+def test_get_blob_storage_data_reports_failed_download(mocker):
+    from azure.core.exceptions import ServiceResponseError
+
+    def chunks():
+        yield b"giga_id_school,school_id,name\nabc,1,one\n"
+        raise ServiceResponseError('Connection reset')
+
+    send_slack_message = mocker.patch('__init__.send_slack_message')
+    blob_service_client = mocker.MagicMock()
+    blob_service_client.get_container_client.return_value.list_blobs.return_value = [
+        {'name': 'gold/school_data/RWA.csv', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x1"'}]
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.chunks.return_value = chunks()
+
+    with pytest.raises(__init__.BlobDownloadError):
+        __init__.get_blob_storage_data(blob_service_client, 'giga', 'Rwanda')
+
+    send_slack_message.assert_called_once_with(
+        message='Error while fetching file: gold/school_data/RWA.csv from container giga')
+
+
+def test_get_partner_data_fetches_partners_and_master(facebook_df, itu_df, master_df, mocker):
+    mocker.patch.dict('os.environ', {'DATA_CONTAINER_NAME': 'giga'})
+    blob_data = {
+        'facebook': (facebook_df, 'processed/RW.csv'),
+        'itu': (itu_df, 'processed/rwa.csv'),
+        'giga': (master_df, 'gold/school_data/RWA.csv')
+    }
+    mocker.patch('__init__.get_blob_storage_data',
+                 side_effect=lambda blob_service_client, container_name, country_name, cancel_event, **kwargs: blob_data[container_name])
+
+    partners_data_dict, partners_master_df = __init__.get_partner_data("Client", 'Rwanda', partners_list=['facebook', 'itu'])
+
+    assert list(partners_data_dict.keys()) == ['facebook', 'itu']
+    assert partners_data_dict['itu']['file_path'] == 'processed/rwa.csv'
+    assert partners_master_df is master_df
+
+
+def test_get_partner_data_cancels_downloads_when_partner_missing(facebook_df, master_df, mocker):
+    mocker.patch.dict('os.environ', {'DATA_CONTAINER_NAME': 'giga'})
+
+    def get_blob_storage_data(blob_service_client, container_name, country_name, cancel_event, **kwargs):
+        if container_name == 'itu':
+            return None, None
+        if not cancel_event.wait(timeout=5):
+            return facebook_df, 'processed/RW.csv'
+        raise __init__.DownloadCancelledError('Blob download cancelled')
+
+    mocker.patch('__init__.get_blob_storage_data', side_effect=get_blob_storage_data)
+
+    start = datetime.now()
+    assert __init__.get_partner_data("Client", 'Rwanda', partners_list=['facebook', 'itu']) == (None, None)
+    assert (datetime.now() - start).total_seconds() < 5
+
+
+def test_upload_to_blob_client_stages_csv_blocks(master_df, mocker):
+    mocker.patch.dict('os.environ', {'BLOB_UPLOAD_BLOCK_SIZE': '16'})
+    staged_blocks = {}
+    blob_service_client = mocker.MagicMock()
+    blob_client = blob_service_client.get_blob_client.return_value
+    blob_client.stage_block.side_effect = lambda block_id, data: staged_blocks.update({block_id: data})
+
+    __init__.upload_to_blob_client(blob_service_client, container='giga', blob_file_path='master.csv', df=master_df,
+                                   overwrite=True)
+
+    block_ids = blob_client.commit_block_list.call_args.args[0]
+    assert len(block_ids) > 1
+    assert b''.join(staged_blocks[block_id] for block_id in block_ids) == master_df.to_csv(index=False).encode()
+    blob_client.upload_blob.assert_not_called()
+
+
+def test_store_files_uploads_all_files(facebook_df, itu_df, master_df, mocker):
+    mocker.patch.dict('os.environ', {'DATA_CONTAINER_NAME': 'giga', 'RAW_COVERAGE_FOLDER': 'raw',
+                                     'PROCESSED_COVERAGE_FOLDER': 'processed', 'MASTER_FILE_FOLDER': 'master'})
+    upload_mock = mocker.patch('__init__.upload_to_blob_client', return_value=None)
+    copy_mock = mocker.patch('__init__.copy_blob', return_value=None)
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df})
+
+    __init__.store_files(country_name='Rwanda', blob_service_client="Client",
+                         partner_file_paths={'facebook': 'processed/RW.csv', 'itu': 'processed/rwa.csv'},
+                         coverage_df=coverage_df, master_df=master_df)
+
+    uploaded_paths = sorted(call.kwargs['blob_file_path'] for call in upload_mock.call_args_list)
+    assert uploaded_paths == ['master/RWA_school_geolocation_coverage_master.csv',
+                              'processed/RWA_school_geolocation_coverage_master.csv']
+    copies = sorted((call.kwargs['source_blob_path'], call.kwargs['blob_file_path'])
+                    for call in copy_mock.call_args_list)
+    assert copies[0][0] == 'processed/RW.csv' and copies[0][1].startswith('raw/facebook/RWA_coverage_data_')
+    assert copies[1][0] == 'processed/rwa.csv' and copies[1][1].startswith('raw/itu/RWA_coverage_data_')
+
+
+def test_store_files_writes_configured_output_formats(facebook_df, itu_df, master_df, mocker):
+    mocker.patch.dict('os.environ', {'DATA_CONTAINER_NAME': 'giga', 'RAW_COVERAGE_FOLDER': 'raw',
+                                     'PROCESSED_COVERAGE_FOLDER': 'processed', 'MASTER_FILE_FOLDER': 'master',
+                                     'OUTPUT_FORMAT': 'csv,parquet'})
+    upload_mock = mocker.patch('__init__.upload_to_blob_client', return_value=None)
+    mocker.patch('__init__.copy_blob', return_value=None)
+
+    __init__.store_files(country_name='Rwanda', blob_service_client="Client",
+                         partner_file_paths={'facebook': 'processed/RW.csv', 'itu': 'processed/rwa.csv'},
+                         coverage_df=master_df, master_df=master_df)
+
+    uploaded_formats = {call.kwargs['blob_file_path']: call.kwargs.get('file_format', 'csv')
+                        for call in upload_mock.call_args_list}
+    assert uploaded_formats['master/RWA_school_geolocation_coverage_master.parquet'] == 'parquet'
+    assert uploaded_formats['master/RWA_school_geolocation_coverage_master.csv'] == 'csv'
+    assert len(uploaded_formats) == 4
+
+
+def test_invalid_output_format(mocker):
+    mocker.patch.dict('os.environ', {'OUTPUT_FORMAT': 'xlsx'})
+    with pytest.raises(ValueError):
+        __init__.get_output_formats()
+
+
+def test_get_blob_storage_data_reads_parquet_master(master_df, mocker):
+    staged_blocks = {}
+    upload_client = mocker.MagicMock()
+    upload_client.get_blob_client.return_value.stage_block.side_effect = \
+        lambda block_id, data: staged_blocks.update({block_id: data})
+    __init__.upload_to_blob_client(upload_client, container='giga', blob_file_path='RWA.parquet',
+                                   df=master_df.assign(unused=1), file_format='parquet')
+    block_ids = upload_client.get_blob_client.return_value.commit_block_list.call_args.args[0]
+
+    blob_service_client = mocker.MagicMock()
+    blob_service_client.get_container_client.return_value.list_blobs.return_value = [
+        {'name': 'gold/school_data/RWA.csv', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x1"'},
+        {'name': 'gold/school_data/RWA.parquet', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x2"'}]
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.chunks.return_value = \
+        iter([staged_blocks[block_id] for block_id in block_ids])
+
+    parquet_master_df, blob_name = __init__.get_blob_storage_data(blob_service_client, 'giga', 'Rwanda')
+
+    assert blob_name == 'gold/school_data/RWA.parquet'
+    assert_frame_equal(master_df, parquet_master_df)
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.readall.assert_not_called()
+
+
+def test_get_blob_storage_data_cancels_parquet_master_download(mocker):
+    cancel_event = threading.Event()
+
+    def chunks():
+        yield b'PAR1'
+        cancel_event.set()
+        yield b'rest of the file'
+
+    blob_service_client = mocker.MagicMock()
+    blob_service_client.get_container_client.return_value.list_blobs.return_value = [
+        {'name': 'gold/school_data/RWA.parquet', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x1"'}]
+    blob_service_client.get_blob_client.return_value.download_blob.return_value.chunks.return_value = chunks()
+
+    with pytest.raises(__init__.DownloadCancelledError):
+        __init__.get_blob_storage_data(blob_service_client, 'giga', 'Rwanda', cancel_event=cancel_event)
+
+
+
+@pytest.mark.parametrize('source, blobs_with_name, expected', [
+    ('master', ['RWA_master.parquet', 'RWA_master.csv'], 'RWA_master.parquet'),
+    # a Parquet master is not read once a newer CSV arrived
+    ('master', ['RWA_master.csv', 'RWA_master.parquet'], 'RWA_master.csv'),
+    ('facebook', ['RW_coverage.parquet', 'RW_coverage.csv'], 'RW_coverage.csv'),
+])
+def test_select_source_blob_reads_newest_master(source, blobs_with_name, expected):
+    source = __init__.MASTER_SOURCE if source == 'master' else __init__.PARTNERS[source]
+
+    assert __init__.select_source_blob(source, blobs_with_name) == expected
+
+
+@pytest.mark.parametrize('country, to, expected', [
+    ('RWA', 'name_short', 'Rwanda'),
+    ('rw', 'name_short', 'Rwanda'),
+    ('Rwanda', 'ISO2', 'RW'),
+    ('Rwanda', 'iso3', 'RWA'),
+    ('NA', 'ISO3', 'NAM'),
+])
+def test_convert_country(country, to, expected):
+    assert __init__.convert_country(country, to=to) == expected
+
+
+def test_convert_country_falls_back_to_country_converter():
+    assert __init__.convert_country('Republic of Rwanda', to='ISO3') == 'RWA'
+
+
+def test_country_code_table_matches_country_converter():
+    import country_converter as coco
+
+    country_codes = __init__.load_country_codes()
+    rows = list({row['ISO3']: row for row in country_codes.values()}.values())
+    country_converter = coco.CountryConverter()
+
+    for column in ['name_short', 'ISO2', 'ISO3']:
+        converted_codes = country_converter.convert([row['ISO3'] for row in rows], to=column)
+        assert [row[column] for row in rows] == converted_codes
+    for code in list(__init__.COUNTRY_CODE_ALIASES) + ['GB', 'GR']:
+        assert country_codes[code.lower()]['ISO3'] == coco.convert(code, to='ISO3')
+
+
+def test_unprocessed_event_does_not_import_heavy_dependencies(unprocessed_data_url):
+    script = f"""
+import sys
+from unittest import mock
+import azure.functions as func
+import __init__
+
+event = func.EventGridEvent(id='1', data={{'blobUrl': '{unprocessed_data_url}'}}, topic='', subject='',
+                            event_type='', event_time=None, data_version='')
+with mock.patch('__init__.send_slack_message'):
+    __init__.main(event)
+print(sorted(module for module in ('pandas', 'numpy', 'azure.storage.blob', 'country_converter') if module in sys.modules))
+"""
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.strip() == '[]'
+
+
+def test_import_timings_are_logged_once(caplog):
+    __init__.LazyModule('json', 'unused_json_alias').dumps({})
+    with caplog.at_level('INFO'):
+        __init__.log_import_timings()
+        __init__.log_import_timings()
+
+    timing_records = [record for record in caplog.records if record.getMessage().startswith('import_timings')]
+    assert 'json' in timing_records[0].custom_dimensions['imports']
+    assert all('json' not in record.custom_dimensions['imports'] for record in timing_records[1:])
+
+
+def test_encode_school_ids_shares_one_dtype(facebook_df, itu_df, master_df):
+    facebook_df.loc[1, 'giga_id_school'] = None
+    encoded_facebook_df, encoded_itu_df, encoded_master_df = __init__.encode_school_ids(facebook_df, itu_df, master_df)
+
+    assert encoded_facebook_df['giga_id_school'].dtype == encoded_master_df['giga_id_school'].dtype
+    assert encoded_facebook_df['giga_id_school'].isna().tolist() == [False, True, False]
+    assert encoded_itu_df['giga_id_school'].astype(object).tolist() == itu_df['giga_id_school'].tolist()
+    assert facebook_df['giga_id_school'].dtype == object
+
+
+def test_master_coverage_merge_with_encoded_school_ids(facebook_df, itu_df, master_df):
+    merged_master_df = merge_coverage_and_master(master_df=master_df,
+                                                 coverage_df=process_coverage_data({'facebook': facebook_df, 'itu': itu_df}))
+
+    facebook_df, itu_df, master_df = __init__.encode_school_ids(facebook_df, itu_df, master_df)
+    encoded_merged_master_df = merge_coverage_and_master(master_df=master_df,
+                                                         coverage_df=process_coverage_data({'facebook': facebook_df, 'itu': itu_df}))
+
+    assert list(encoded_merged_master_df.columns) == __init__.MASTER_COLUMNS
+    assert encoded_merged_master_df['coverage_type'].tolist() == ['4G', '3G', '4G', '4G']
+    assert encoded_merged_master_df['lat'].isna().all()
+    assert encoded_merged_master_df.to_csv(index=False) == merged_master_df.to_csv(index=False)
+
+
+def test_incremental_processing_only_processes_changed_schools(facebook_df, itu_df, mocker):
+    mocker.patch.dict('os.environ', {'PROCESSED_COVERAGE_FOLDER': 'processed'})
+    mocker.patch('__init__.read_coverage_state', return_value=None)
+    _, coverage_state_df = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+
+    state_data = io.BytesIO()
+    coverage_state_df.to_parquet(state_data)
+    mocker.patch('__init__.read_coverage_state', return_value=pd.read_parquet(io.BytesIO(state_data.getvalue())))
+    process_spy = mocker.spy(__init__, 'process_coverage_data')
+
+    facebook_df.loc[1, 'percent_4G'] = 70
+    coverage_df, _ = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+
+    assert process_spy.call_args.kwargs['partner_dfs']['facebook']['giga_id_school'].tolist() == [facebook_df.loc[1, 'giga_id_school']]
+    assert coverage_df['giga_id_school'].tolist() == facebook_df['giga_id_school'][[0, 2, 1]].tolist()
+    assert coverage_df['coverage_type'].tolist() == ['4G', '4G', '4G']
+
+
+def test_full_run_replaces_coverage_state_without_reading_it(facebook_df, itu_df, mocker):
+    read_coverage_state = mocker.patch('__init__.read_coverage_state')
+
+    coverage_df, coverage_state_df = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df}, full=True)
+
+    read_coverage_state.assert_not_called()
+    assert_frame_equal(coverage_df, process_coverage_data({'facebook': facebook_df, 'itu': itu_df}))
+    assert len(coverage_state_df) == len(coverage_df)
+
+
+def test_incremental_processing_processes_all_schools_when_coverage_rules_changed(facebook_df, itu_df, mocker):
+    mocker.patch.dict('os.environ', {'PROCESSED_COVERAGE_FOLDER': 'processed'})
+    mocker.patch('__init__.read_coverage_state', return_value=None)
+    _, coverage_state_df = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+    mocker.patch('__init__.read_coverage_state', return_value=coverage_state_df)
+
+    mocker.patch.dict(__init__.PARTNERS['facebook'], {'coverage_rules': {
+        '2G': ('percent_2G', operator.gt, 50), '3G': ('percent_3G', operator.gt, 50), '4G': ('percent_4G', operator.gt, 50)}})
+    process_spy = mocker.spy(__init__, 'process_coverage_data')
+    coverage_df, _ = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+
+    assert process_spy.call_args.kwargs['partner_dfs']['facebook'] is facebook_df
+    assert_frame_equal(coverage_df, process_coverage_data({'facebook': facebook_df, 'itu': itu_df}))
+
+
+def test_incremental_processing_processes_all_schools_when_partner_columns_changed(facebook_df, itu_df, mocker):
+    mocker.patch.dict('os.environ', {'PROCESSED_COVERAGE_FOLDER': 'processed'})
+    mocker.patch('__init__.read_coverage_state', return_value=None)
+    _, coverage_state_df = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+    mocker.patch('__init__.read_coverage_state', return_value=coverage_state_df)
+
+    itu_df['fiber_node_distance'] = [1.5, 2.5, 3.5]
+    coverage_df, _ = __init__.process_coverage_data_incrementally(
+        "Client", 'Rwanda', {'facebook': facebook_df, 'itu': itu_df})
+
+    assert_frame_equal(coverage_df, process_coverage_data({'facebook': facebook_df, 'itu': itu_df}))
+
+
+def test_explicit_incremental_run_uses_coverage_state_when_setting_off(facebook_df, itu_df, master_df, mocker):
+    mocker.patch.dict('os.environ', {'INCREMENTAL_PROCESSING': 'false'})
+    mocker.patch('__init__.get_out_of_core_partitions', return_value=1)
+    mocker.patch('__init__.get_partner_data', return_value=(
+        {'facebook': {'data': facebook_df, 'file_path': 'processed/RW.csv'},
+         'itu': {'data': itu_df, 'file_path': 'processed/rwa.csv'}}, master_df))
+    mocker.patch('__init__.store_files')
+    read_coverage_state = mocker.patch('__init__.read_coverage_state', return_value=None)
+    store_coverage_state = mocker.patch('__init__.store_coverage_state')
+
+    __init__.process_country_coverage("Client", 'Rwanda', delete_partner_files=False, incremental=True)
+
+    read_coverage_state.assert_called_once()
+    store_coverage_state.assert_called_once()
+
+
+def test_slack_messages_reuse_connection(stand_in_server, pooled_clients):
+    server_url, received_requests, _ = stand_in_server
+
+    __init__.send_slack_message(message='first', webhook=f'{server_url}/webhook')
+    assert __init__.flush_slack_messages(timeout=5)
+    __init__.send_slack_message(message='second', webhook=f'{server_url}/webhook')
+    assert __init__.flush_slack_messages(timeout=5)
+
+    assert [request['body'] for request in received_requests] == [b'{"text": "first"}', b'{"text": "second"}']
+    assert len({request['port'] for request in received_requests}) == 1
+
+
+def test_blob_client_is_reused_across_invocations(stand_in_server, pooled_clients, mocker):
+    server_url, received_requests, _ = stand_in_server
+    connection_string = ('DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;'
+                         f'BlobEndpoint={server_url}/devstoreaccount1;')
+    mocker.patch.dict('os.environ', {'saunigiga_STORAGE': connection_string})
+
+    for _ in range(2):
+        blob_service_client = __init__.create_blob_client()
+        blob_service_client.get_blob_client(container='giga', blob='RWA.csv').delete_blob()
+
+    assert blob_service_client is __init__.create_blob_client()
+    assert [request['method'] for request in received_requests] == ['DELETE', 'DELETE']
+    assert len({request['port'] for request in received_requests}) == 1
+
+
+def test_slack_message_is_sent_in_the_background(stand_in_server, pooled_clients):
+    server_url, received_requests, scripted_responses = stand_in_server
+    scripted_responses.append((1, 200))
+
+    start = time.monotonic()
+    __init__.send_slack_message(message='slow webhook', webhook=f'{server_url}/webhook')
+
+    assert time.monotonic() - start < 0.5
+    assert __init__.flush_slack_messages(timeout=5)
+    assert [request['body'] for request in received_requests] == [b'{"text": "slow webhook"}']
+
+
+def test_slack_messages_queued_together_are_batched(stand_in_server, pooled_clients, mocker):
+    server_url, received_requests, _ = stand_in_server
+    mocker.patch.dict('os.environ', {'SLACK_BATCH_SECONDS': '60'})
+
+    __init__.send_slack_message(message='first', webhook=f'{server_url}/webhook')
+    __init__.send_slack_message(message='second', webhook=f'{server_url}/webhook')
+    __init__.send_slack_message(message='other channel', webhook=f'{server_url}/other')
+
+    assert __init__.flush_slack_messages(timeout=5)
+    assert [(request['path'], request['body']) for request in received_requests] == [
+        ('/webhook', b'{"text": "first\\n\\nsecond"}'), ('/other', b'{"text": "other channel"}')]
+
+
+def test_slack_error_on_one_webhook_does_not_drop_other_batches(stand_in_server, pooled_clients, mocker):
+    server_url, received_requests, _ = stand_in_server
+    mocker.patch.dict('os.environ', {'SLACK_BATCH_SECONDS': '60'})
+    send_batch = __init__.SlackNotifier.send_batch
+
+    def fail_broken_webhook(self, webhook, messages):
+        if webhook.endswith('/broken'):
+            raise ValueError('unexpected webhook answer')
+        return send_batch(self, webhook=webhook, messages=messages)
+
+    mocker.patch.object(__init__.SlackNotifier, 'send_batch', fail_broken_webhook)
+
+    __init__.send_slack_message(message='lost', webhook=f'{server_url}/broken')
+    __init__.send_slack_message(message='delivered', webhook=f'{server_url}/webhook')
+
+    assert __init__.flush_slack_messages(timeout=5)
+    assert [(request['path'], request['body']) for request in received_requests] == [
+        ('/webhook', b'{"text": "delivered"}')]
+
+
+@pytest.mark.parametrize('scripted_failures,expected_attempts', [
+    ([(1, 200)], 2),
+    ([(0, 503), (0, 429)], 3),
+    ([(0, 500)] * 3, 3),
+    ([(0, 400)], 1),
+])
+def test_slack_batch_is_retried_with_backoff(stand_in_server, pooled_clients, mocker, scripted_failures,
+                                             expected_attempts):
+    server_url, received_requests, scripted_responses = stand_in_server
+    scripted_responses.extend(scripted_failures)
+    mocker.patch.dict('os.environ', {'SLACK_TIMEOUT_SECONDS': '0.2', 'SLACK_MAX_ATTEMPTS': '3',
+                                     'SLACK_RETRY_BACKOFF_SECONDS': '0.1'})
+
+    __init__.send_slack_message(message='flaky webhook', webhook=f'{server_url}/webhook')
+
+    assert __init__.flush_slack_messages(timeout=10)
+    assert [request['body'] for request in received_requests] == [b'{"text": "flaky webhook"}'] * expected_attempts
+    # the timed out attempt waits for its timeout, the failed ones back off 0.1 and then 0.2 seconds
+    arrival_gaps = [later['received_at'] - earlier['received_at']
+                    for earlier, later in zip(received_requests, received_requests[1:])]
+    assert all(gap >= 0.1 * 2 ** attempt for attempt, gap in enumerate(arrival_gaps))
+
+
+def test_slack_messages_are_flushed_when_an_invocation_fails(partner_event_processed, stand_in_server,
+                                                             pooled_clients, mocker):
+    server_url, received_requests, _ = stand_in_server
+    mocker.patch.dict('os.environ', {'SLACK_WEBHOOK': f'{server_url}/webhook', 'SLACK_BATCH_SECONDS': '60'})
+    mocker.patch('__init__.create_blob_client', return_value='Client')
+    mocker.patch('__init__.create_coordination_store', return_value=__init__.LocalCoordinationStore())
+
+    def fail_processing(blob_service_client, country_name, **kwargs):
+        __init__.send_slack_message(message=f'Error while processing {country_name}')
+        raise RuntimeError('processing failed')
+
+    mocker.patch('__init__.process_country_coverage', side_effect=fail_processing)
+
+    with pytest.raises(RuntimeError):
+        main(partner_event_processed)
+
+    assert [request['body'] for request in received_requests] == [b'{"text": "Error while processing Rwanda"}']
+
+
+def test_burst_of_events_is_coalesced_into_one_more_run():
+    coordination_store = __init__.LocalCoordinationStore()
+    first_run_started = threading.Event()
+    finish_first_run = threading.Event()
+    processed_countries = []
+
+    def process(country_name):
+        processed_countries.append(country_name)
+        first_run_started.set()
+        finish_first_run.wait(timeout=5)
+        return "Coverage data has been processed and saved"
+
+    first_event = threading.Thread(target=__init__.process_coalesced, args=(coordination_store, 'Rwanda', process))
+    first_event.start()
+    first_run_started.wait(timeout=5)
+
+    # events arriving during the run only mark the country as pending
+    assert __init__.process_coalesced(coordination_store, 'Rwanda', process) == {}
+    assert __init__.process_coalesced(coordination_store, 'Rwanda', process) == {}
+
+    finish_first_run.set()
+    first_event.join(timeout=5)
+
+    assert processed_countries == ['Rwanda', 'Rwanda']
+    assert coordination_store.list_pending() == []
+
+
+def test_pending_countries_are_batched_into_one_invocation(mocker):
+    mocker.patch.dict('os.environ', {'COALESCE_MAX_COUNTRIES': '2'})
+    coordination_store = __init__.LocalCoordinationStore()
+    coordination_store.mark_pending('Kenya')
+    coordination_store.mark_pending('Niger')
+
+    processing_results = __init__.process_coalesced(coordination_store, 'Rwanda', process=lambda name: f'{name} done')
+
+    assert processing_results == {'Rwanda': 'Rwanda done', 'Kenya': 'Kenya done'}
+    assert coordination_store.list_pending() == ['Niger']
+
+
+def test_blob_coordination_store_lease_held_elsewhere(mocker):
+    from azure.core.exceptions import ResourceExistsError
+
+    blob_service_client = mocker.MagicMock()
+    lock_blob_client = blob_service_client.get_container_client.return_value.get_blob_client.return_value
+    lock_blob_client.upload_blob.side_effect = ResourceExistsError('BlobAlreadyExists')
+    lock_blob_client.acquire_lease.side_effect = ResourceExistsError('LeaseAlreadyPresent', response=mocker.Mock(status_code=409))
+    coordination_store = __init__.BlobCoordinationStore(blob_service_client, container='giga', folder='coordination')
+
+    assert not coordination_store.acquire_lease('Rwanda')
+    blob_service_client.get_container_client.return_value.get_blob_client.assert_called_with('coordination/locks/RWA')
+
+
+def test_blob_coordination_store_lease_lost_when_renewal_fails(mocker):
+    from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+    mocker.patch('__init__.COORDINATION_LEASE_SECONDS', 0.02)
+    blob_service_client = mocker.MagicMock()
+    lease = blob_service_client.get_container_client.return_value.get_blob_client.return_value.acquire_lease.return_value
+    lease.renew.side_effect = HttpResponseError('LeaseIdMismatchWithLeaseOperation')
+    lease.release.side_effect = ServiceRequestError('Connection refused')
+    coordination_store = __init__.BlobCoordinationStore(blob_service_client, container='giga', folder='coordination')
+
+    assert coordination_store.acquire_lease('Rwanda')
+    deadline = time.monotonic() + 5
+    while coordination_store.holds_lease('Rwanda') and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert not coordination_store.holds_lease('Rwanda')
+    coordination_store.release_lease('Rwanda')
+    lease.release.assert_called_once()
+
+
+def test_process_country_coverage_does_not_store_files_without_lease(facebook_df, itu_df, master_df, mocker):
+    mocker.patch('__init__.get_out_of_core_partitions', return_value=1)
+    mocker.patch('__init__.get_partner_data', return_value=(
+        {'facebook': {'data': facebook_df, 'file_path': 'processed/RW.csv'},
+         'itu': {'data': itu_df, 'file_path': 'processed/rwa.csv'}}, master_df))
+    store_files = mocker.patch('__init__.store_files')
+    send_slack_message = mocker.patch('__init__.send_slack_message')
+
+    with pytest.raises(__init__.LeaseLostError):
+        __init__.process_country_coverage("Client", 'Rwanda', coordination_store=__init__.LocalCoordinationStore())
+
+    store_files.assert_not_called()
+    assert send_slack_message.call_args.kwargs['message'].startswith('Error while saving files')
+
+
+def test_backfill_resumes_from_checkpoint(tmp_path, mocker):
+    import backfill
+    from concurrent.futures import ThreadPoolExecutor
+
+    checkpoint_path = str(tmp_path / 'backfill_checkpoint.json')
+    backfill.save_checkpoint(checkpoint_path, {'completed': {'Kenya': 'done'}, 'failed': {'Niger': 'Traceback'}})
+
+    def backfill_country(country_name):
+        if country_name == 'Rwanda':
+            raise ValueError('broken partner file')
+        return f'{country_name} done'
+
+    backfill_country_mock = mocker.patch('backfill.backfill_country', side_effect=backfill_country)
+
+    checkpoint = backfill.run_backfill(['Kenya', 'Niger', 'Rwanda'], checkpoint_path, max_workers=2,
+                                       executor_factory=ThreadPoolExecutor)
+
+    assert sorted(call.args[0] for call in backfill_country_mock.call_args_list) == ['Niger', 'Rwanda']
+    assert checkpoint['completed'] == {'Kenya': 'done', 'Niger': 'Niger done'}
+    assert list(checkpoint['failed']) == ['Rwanda']
+    assert 'broken partner file' in checkpoint['failed']['Rwanda']
+    assert backfill.load_checkpoint(checkpoint_path) == checkpoint
+
+
+def test_backfill_country_keeps_partner_files(mocker):
+    import backfill
+
+    coordination_store = __init__.LocalCoordinationStore()
+    mocker.patch('__init__.create_blob_client')
+    mocker.patch('__init__.create_coordination_store', return_value=coordination_store)
+    process_country_coverage = mocker.patch('__init__.process_country_coverage', return_value='done')
+
+    assert backfill.backfill_country('Rwanda') == 'done'
+    assert process_country_coverage.call_args.kwargs['delete_partner_files'] is False
+    assert process_country_coverage.call_args.kwargs['incremental'] is False
+    assert coordination_store.acquire_lease('Rwanda')
+
+
+def test_backfill_country_processes_files_received_during_the_backfill(mocker):
+    import backfill
+
+    coordination_store = __init__.LocalCoordinationStore()
+    mocker.patch('__init__.create_blob_client')
+    mocker.patch('__init__.create_coordination_store', return_value=coordination_store)
+
+    def process_country_coverage(blob_service_client, country_name, **kwargs):
+        if kwargs.get('incremental') is False:
+            # an event for the country arrives while the backfill holds its lease
+            coordination_store.mark_pending(country_name)
+            assert not coordination_store.acquire_lease(country_name)
+            return 'backfilled'
+        return 'processed'
+
+    process_mock = mocker.patch('__init__.process_country_coverage', side_effect=process_country_coverage)
+
+    assert backfill.backfill_country('Rwanda') == 'backfilled\nFiles received during the backfill: processed'
+    assert 'delete_partner_files' not in process_mock.call_args.kwargs
+    assert not coordination_store.is_pending('Rwanda')
+
+
+def report_inherited_clients(country_name):
+    return f'{__init__._http_session is None} {len(__init__._blob_service_clients)} {__init__._slack_notifier is None}'
+
+
+def test_backfill_workers_do_not_inherit_pooled_clients(tmp_path, pooled_clients, mocker):
+    import backfill
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    import multiprocessing
+
+    # clients of the parent, e.g. the one listing the countries to backfill
+    __init__.get_http_session()
+    __init__._blob_service_clients['connection string'] = object()
+    __init__.get_slack_notifier()
+    mocker.patch('backfill.backfill_country', report_inherited_clients)
+
+    checkpoint = backfill.run_backfill(
+        ['Rwanda'], str(tmp_path / 'backfill_checkpoint.json'), max_workers=1,
+        executor_factory=partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('fork')))
+
+    assert checkpoint['completed'] == {'Rwanda': 'True 0 True'}
+    assert __init__._http_session is not None
+
+
+def test_upload_stage_metrics_are_logged(master_df, mocker, caplog):
+    blob_service_client = mocker.MagicMock()
+    with caplog.at_level('INFO'):
+        __init__.upload_to_blob_client(blob_service_client, container='giga', blob_file_path='master.csv', df=master_df,
+                                       overwrite=True)
+
+    stage_metrics = [record.custom_dimensions for record in caplog.records
+                     if record.getMessage().startswith('stage_metrics')]
+    assert stage_metrics[-1]['stage'] == 'upload'
+    assert stage_metrics[-1]['rows'] == len(master_df)
+    assert stage_metrics[-1]['bytes_uploaded'] == len(master_df.to_csv(index=False).encode())
+    assert stage_metrics[-1]['succeeded']
+
+
+def test_failed_stage_is_logged(caplog):
+    with caplog.at_level('INFO'), pytest.raises(ValueError):
+        with __init__.measure_stage('merge', country='Rwanda'):
+            raise ValueError('broken merge')
+
+    assert caplog.records[-1].custom_dimensions['stage'] == 'merge'
+    assert not caplog.records[-1].custom_dimensions['succeeded']
+
+
+@pytest.mark.parametrize('profiler, extension', [('cprofile', '.prof'), ('tracemalloc', '.tracemalloc')])
+def test_profile_invocation_dumps_profile(tmp_path, mocker, profiler, extension):
+    mocker.patch.dict('os.environ', {'PROFILE_INVOCATION': profiler, 'PROFILE_OUTPUT_FOLDER': str(tmp_path)})
+
+    with __init__.profile_invocation('RWA_coverage'):
+        sorted(range(1000), reverse=True)
+
+    assert [path.suffix for path in tmp_path.iterdir()] == [extension]
+
+
+def test_apply_schema_only_compacts_columns_that_fit():
+    df = pd.DataFrame({'2G': [0, 1, 2], '3G': [1.0, None, 0.0], '4G': [1, 'yes', 0], 'percent_2G': [10, 20, 30],
+                       'percent_3G': [0.1, 0.5, 1.0], 'admin1': ['North', 'South', 'North']})
+    schema = {'2G': 'int8', '3G': 'int8', '4G': 'int8', 'percent_2G': 'float32', 'percent_3G': 'float32',
+              'admin1': 'category'}
+    validation_report = {}
+
+    __init__.apply_schema(df, schema=schema, validation_report=validation_report)
+
+    assert df.dtypes.astype(str).to_dict() == {'2G': 'int8', '3G': 'float32', '4G': 'object', 'percent_2G': 'int8',
+                                               'percent_3G': 'float64', 'admin1': 'category'}
+    assert validation_report == {'4G': {'dtype': 'int8', 'rows': 1, 'examples': ['yes']},
+                                 'percent_3G': {'dtype': 'float32', 'rows': 1, 'examples': ['0.1']}}
+
+
+def test_read_csv_in_chunks_applies_schema_to_every_chunk(master_df):
+    master_df['admin1'] = ['North', 'South', 'East', 'North']
+    master_df['num_students'] = [120, None, 80, 300]
+    csv_data = master_df.to_csv(index=False)
+
+    compact_df = __init__.read_csv_in_chunks(io.BytesIO(csv_data.encode()), columns=__init__.MASTER_COLUMNS,
+                                             chunk_rows=2, schema=__init__.MASTER_SCHEMA)
+
+    assert list(compact_df['admin1'].cat.categories) == ['East', 'North', 'South']
+    assert compact_df['num_students'].dtype == 'float32'
+    assert compact_df.to_csv(index=False) == csv_data
+
+
+def test_registered_partner_joins_coverage_processing(facebook_df, itu_df, mocker):
+    mocker.patch.dict('__init__.PARTNERS', {'opencellid': {
+        'file_prefix': 'processed/{ISO3}', 'columns': ['giga_id_school', 'lte_cells'], 'schema': {},
+        'coverage_rules': {'4G': ('lte_cell_count', operator.gt, 0)}, 'renamed_columns': {'lte_cells': 'lte_cell_count'},
+        'coverage_columns': ['lte_cell_count']}})
+    opencellid_df = pd.DataFrame({'giga_id_school': facebook_df['giga_id_school'][[1, 2]].tolist() + ['new-school'],
+                                  'lte_cells': [3, 0, 1]})
+
+    coverage_df = process_coverage_data({'facebook': facebook_df, 'itu': itu_df, 'opencellid': opencellid_df})
+
+    # the second school only has 3G from facebook and ITU
+    assert coverage_df['giga_id_school'].tolist() == facebook_df['giga_id_school'].tolist() + ['new-school']
+    assert coverage_df['4G_coverage'].tolist() == ['YES', 'YES', 'YES', 'YES']
+    assert coverage_df['lte_cell_count'].fillna(-1).tolist() == [-1, 3, 0, 1]
+
+
+def test_blob_index_resolves_newest_blob_without_relisting(mocker):
+    from azure.core.exceptions import ResourceNotFoundError
+
+    blob_service_client = mocker.MagicMock()
+    list_blobs = blob_service_client.get_container_client.return_value.list_blobs
+    list_blobs.return_value = [
+        {'name': 'processed/RW_old.csv', 'last_modified': datetime(2024, 1, 1), 'etag': '"0x1"'},
+        {'name': 'processed/RW_new.csv', 'last_modified': datetime(2024, 2, 1), 'etag': '"0x2"'}]
+    get_blob_properties = blob_service_client.get_blob_client.return_value.get_blob_properties
+    get_blob_properties.return_value.etag = '"0x2"'
+
+    def find_latest_blobs():
+        return __init__.find_latest_blobs(blob_service_client, 'coverage-data-facebook', 'processed/RW')
+
+    assert find_latest_blobs() == ['processed/RW_new.csv', 'processed/RW_old.csv']
+    assert find_latest_blobs() == ['processed/RW_new.csv', 'processed/RW_old.csv']
+
+    # a blob from an EventGrid event becomes the newest without listing the container again
+    __init__.record_blob('coverage-data-facebook', 'processed/RW_event.csv', etag='"0x3"')
+    get_blob_properties.return_value.etag = '"0x3"'
+    assert find_latest_blobs()[0] == 'processed/RW_event.csv'
+    assert list_blobs.call_count == 1
+
+    # the newest blob was deleted by another worker
+    get_blob_properties.side_effect = ResourceNotFoundError('BlobNotFound')
+    assert find_latest_blobs() == ['processed/RW_new.csv', 'processed/RW_old.csv']
+    assert list_blobs.call_count == 2
+
+
+def test_upload_is_skipped_when_content_digest_matches(master_df, mocker):
+    blob_service_client = mocker.MagicMock()
+    blob_client = blob_service_client.get_blob_client.return_value
+    blob_client.get_blob_properties.return_value.metadata = {
+        'content_digest': __init__.content_digest(master_df, file_format='csv', compression='zstd')}
+
+    assert __init__.upload_to_blob_client(blob_service_client, container='giga', blob_file_path='master.csv',
+                                          df=master_df, overwrite=True) is None
+    blob_client.stage_block.assert_not_called()
+
+    master_df.loc[0, 'name'] = 'renamed'
+    __init__.upload_to_blob_client(blob_service_client, container='giga', blob_file_path='master.csv', df=master_df,
+                                   overwrite=True)
+    assert blob_client.commit_block_list.call_args.kwargs['metadata'] == {
+        'content_digest': __init__.content_digest(master_df, file_format='csv', compression='zstd')}
+
+
+def test_copy_blob_waits_for_pending_copy(mocker):
+    mocker.patch('__init__.COPY_POLL_SECONDS', 0)
+    blob_service_client = mocker.MagicMock()
+    blob_client = blob_service_client.get_blob_client.return_value
+    blob_client.url = 'https://saunigiga.blob.core.windows.net/coverage-data-itu/processed/rwa.csv'
+    blob_client.start_copy_from_url.return_value = {'copy_status': 'pending'}
+    type(blob_client.get_blob_properties.return_value.copy).status = mocker.PropertyMock(
+        side_effect=['pending', 'success'])
+
+    __init__.copy_blob(blob_service_client, source_container='coverage-data-itu', source_blob_path='processed/rwa.csv',
+                       container='giga', blob_file_path='raw/itu/RWA_coverage_data.csv')
+
+    blob_client.start_copy_from_url.assert_called_once_with(blob_client.url)
+    assert blob_client.get_blob_properties.call_count == 2
+
+    blob_client.start_copy_from_url.return_value = {'copy_status': 'failed'}
+    with pytest.raises(RuntimeError):
+        __init__.copy_blob(blob_service_client, source_container='coverage-data-itu',
+                           source_blob_path='processed/rwa.csv', container='giga',
+                           blob_file_path='raw/itu/RWA_coverage_data.csv')
+
+
+@pytest.mark.parametrize('dtypes, expected', [
+    (['int8', 'int8'], 'int8'),
+    (['int8', 'float32'], 'float32'),
+    (['bool', 'int8'], 'object'),
+    (['float32', 'object'], 'object'),
+    ([pd.CategoricalDtype(['a']), pd.CategoricalDtype(['b'])], pd.CategoricalDtype(['a', 'b'])),
+])
+def test_common_dtype(dtypes, expected):
+    assert __init__.common_dtype([pd.api.types.pandas_dtype(dtype) for dtype in dtypes]) == expected
+
+
+def test_out_of_core_partitions_keep_estimated_memory_under_limit(mocker, monkeypatch):
+    monkeypatch.setenv('DATA_CONTAINER_NAME', 'giga')
+    mocker.patch('__init__.find_source_blobs', side_effect=lambda blob_service_client, container_name, country_name: (
+        {}, container_name, [f'processed/{container_name}.csv']))
+    blob_service_client = mocker.MagicMock()
+    blob_service_client.get_blob_client.return_value.get_blob_properties.return_value.size = 1000
+
+    assert __init__.get_out_of_core_partitions(blob_service_client, 'Rwanda') == 1
+
+    # three files of 1000 bytes, estimated at 4 bytes of memory per byte of CSV
+    monkeypatch.setenv('OUT_OF_CORE_MEMORY_LIMIT', '5000')
+    assert __init__.get_out_of_core_partitions(blob_service_client, 'Rwanda') == 3
+
+    monkeypatch.setenv('OUT_OF_CORE_MEMORY_LIMIT', '12000')
+    assert __init__.get_out_of_core_partitions(blob_service_client, 'Rwanda') == 1
+
+
+@pytest.mark.parametrize('partitions', [1, 3])
+def test_out_of_core_processing_matches_in_memory(tmp_path, monkeypatch, partitions):
+    # rows are spilled and merged back a few at a time
+    monkeypatch.setenv('CSV_READ_CHUNK_ROWS', '3')
+    # ids out of sorted order, which the schools keep
+    school_ids = ['s-9', 's-1', 's-5', 's-3', 's-7', 's-2', 's-8', 's-4']
+    facebook_df = pd.DataFrame({'giga_id_school': school_ids[:5] + [school_ids[2], None],
+                                'percent_2G': [90, 80, 0, 10, 50, 70, 20], 'percent_3G': [40, 0, 0, 5, 50, 10, None],
+                                'percent_4G': [30, 0, 0, 0, 50, 0, 0]})
+    itu_df = pd.DataFrame({'giga_id_school': school_ids[6:] + school_ids[3::-1] + [None],
+                           '2G': [1, 0, 1, 1, 0, 1, 0], '3G': [1, 0, 0, 1, 0, 1, 1], '4G': [1, 0, 0, 0, 0, 1, 0]})
+    master_df = pd.DataFrame({'giga_id_school': school_ids[::-1] + [school_ids[2], None, 'no-coverage'],
+                              'school_id': range(11), 'name': [f'name-{i}' for i in range(11)]})
+
+    *partner_dfs, in_memory_master_df = __init__.encode_school_ids(facebook_df, itu_df, master_df)
+    coverage_df = process_coverage_data(partner_dfs=dict(zip(__init__.PARTNERS_LIST, partner_dfs)))
+    master_with_coverage = merge_coverage_and_master(master_df=in_memory_master_df, coverage_df=coverage_df)
+
+    spills = {}
+    for name, df in [('facebook', facebook_df), ('itu', itu_df), ('master', master_df)]:
+        spills[name] = __init__.SpilledFrame(folder=str(tmp_path), name=name, partitions=partitions)
+        # appended in chunks, the way get_blob_storage_data spills a file as it is parsed
+        for start in range(0, len(df), 3):
+            spills[name].append(df[start:start + 3])
+    master_spill = spills.pop('master')
+
+    coverage_spill, master_with_coverage_spill = __init__.process_partitions(
+        partner_spills=spills, master_spill=master_spill, spill_folder=str(tmp_path))
+
+    for df, spill in [(coverage_df, coverage_spill), (master_with_coverage, master_with_coverage_spill)]:
+        csv_data = io.StringIO()
+        spill.to_csv(csv_data, index=False)
+        assert csv_data.getvalue() == df.to_csv(index=False)
+        assert len(spill) == len(df)
+
+
+def test_country_over_memory_limit_is_processed_out_of_core(partner_event_processed, mocker):
+    mocker.patch('__init__.create_blob_client')
+    mocker.patch('__init__.create_coordination_store', return_value=__init__.LocalCoordinationStore())
+    mocker.patch('__init__.get_out_of_core_partitions', return_value=4)
+    get_partner_data = mocker.patch('__init__.get_partner_data')
+    process_out_of_core = mocker.patch('__init__.process_country_coverage_out_of_core',
+                                       return_value='Coverage data has been processed and saved')
+    send_slack_message = mocker.patch('__init__.send_slack_message')
+
+    main(partner_event_processed)
+
+    assert process_out_of_core.call_args.kwargs['partitions'] == 4
+    get_partner_data.assert_not_called()
+    assert send_slack_message.call_args.kwargs['message'].endswith('Coverage data has been processed and saved')
+
+
+def test_concat_chunks_from_generator_matches_list():
+    chunks = [pd.DataFrame({'giga_id_school': pd.Categorical(['a', 'b']), 'percent_2G': pd.Series([1, 2], dtype='int8')}),
+              pd.DataFrame({'giga_id_school': pd.Categorical(['c']), 'percent_2G': pd.Series([0.5], dtype='float32')})]
+
+    expected_df = __init__.concat_chunks([chunk.copy() for chunk in chunks])
+
+    assert_frame_equal(__init__.concat_chunks(chunk.copy() for chunk in chunks), expected_df)
+    assert expected_df.dtypes.astype(str).tolist() == ['category', 'float32']